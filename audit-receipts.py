@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+# -*- coding: UTF8 -*-
+"""
+audit-receipts.py
+проверка согласованности чисел в хранилищах и в наборе данных экспорта (см. src/audit.py)
+"""
+import argparse
+import logging
+import os
+import sys
+
+PROJECT_PATH = os.path.dirname(os.path.abspath(__file__))
+SOURCE_PATH = os.path.join(PROJECT_PATH, "src")
+sys.path.append(SOURCE_PATH)
+
+import audit
+import dataset
+import log
+import storage
+import tsv
+
+def parse_options():
+  argument_parser = argparse.ArgumentParser(description = 'Checks consistency of extracted numbers')
+  argument_parser.add_argument('--storages', default = SOURCE_PATH, metavar = 'DIR', help = 'folder with storages json files')
+  argument_parser.add_argument('--dataset', metavar = 'FILE', help = 'exported dataset (output/receipt.parquet)')
+  argument_parser.add_argument('--conf', nargs = '*', default = [os.path.join(PROJECT_PATH, 'conf', 'schema-receipt.json')],
+                               metavar = 'FILE', help = 'json configurations for the dataset')
+  return argument_parser.parse_args()
+
+def main():
+  args = parse_options()
+  log.init_logging(None, logging.INFO)
+  violations = []
+  for s in storage.load_storages(args.storages):
+    violations.extend(audit.audit_storage(s))
+  if not args.dataset is None:
+    configurations = list(map(tsv.load_json_configuration, args.conf))
+    violations.extend(audit.audit_dataset(dataset.load(args.dataset), configurations))
+  for v in violations:
+    print(f"{v['month']} {v['row']}: {v['check']} ({v['lhs']:.2f} != {v['rhs']:.2f})")
+  sys.exit(0 if len(violations) == 0 else 2)
+
+if __name__ == '__main__':
+  main()
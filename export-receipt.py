@@ -1,66 +1,139 @@
 #!/usr/bin/python3
-import datetime
+# -*- coding: UTF8 -*-
+"""
+export-receipt.py [-i INPUT_DIR] [-o OUTPUT_DIR] [--conf FILE ...] [--storages DIR] [--pages-per-job N] [--bench N]
+распознает pdf квитанции и сохраняет набор данных экспорта (receipt.csv.gz и receipt.parquet),
+с --storages квитанции также записываются в месячные файлы хранилищ (те же, что показывает gui),
+в режиме --bench корпус обрабатывается N раз и выводится пропускная способность (хранилища не изменяются)
+"""
+import argparse
 import glob
 import logging
 import os
-import shutil
 import sys
+import time
 
 import pandas as pd
-import matplotlib.pyplot as plt
 
-PROJECT_PATH = os.getcwd()
+PROJECT_PATH = os.path.dirname(os.path.abspath(__file__))
 SOURCE_PATH = os.path.join(PROJECT_PATH, "src")
 sys.path.append(SOURCE_PATH)
 
+import dataset
 import log
+import pdf_archive
 import pdf_utils
-import tsv
+import perf
+import pipeline
+import storage
 
 OUTPUT_DIR = 'output'
+COMPRESS_LEVEL = 9
+CONFIGURATIONS = [os.path.join('conf', name) for name in ['schema-receipt.json', 'schema-complete-renovation.json']]
 
-if not os.path.lexists(OUTPUT_DIR):
-  os.mkdir(OUTPUT_DIR)
+def parse_options():
+  argument_parser = argparse.ArgumentParser(description = 'Recognizes PDF receipts and exports extracted numbers')
+  argument_parser.add_argument('-i', '--input', default = 'input', metavar = 'DIR', help = 'folder with PDF receipts')
+  argument_parser.add_argument('-o', '--output', default = OUTPUT_DIR, metavar = 'DIR', help = 'output folder')
+  argument_parser.add_argument('--conf', nargs = '+', default = CONFIGURATIONS, metavar = 'FILE', help = 'json configurations of receipts')
+  argument_parser.add_argument('--storages', metavar = 'DIR',
+                               help = 'also save receipts into storages from json files in DIR (e.g. src), ignored with --bench')
+  argument_parser.add_argument('--compress-level', type = int, default = COMPRESS_LEVEL, choices = range(0, 10),
+                               metavar = '0-9', help = 'gzip compression level of receipt.csv.gz')
+  argument_parser.add_argument('-j', '--jobs', type = int, metavar = 'N', help = 'number of parallel conversion jobs')
+  argument_parser.add_argument('--pages-per-job', type = int, metavar = 'N',
+                               help = 'convert multi-page PDF files in parallel ranges of N pages (needs pdfinfo)')
+  argument_parser.add_argument('--bench', type = int, metavar = 'N', help = 'process input N times and report throughput')
+  argument_parser.add_argument('-l', '--log', metavar = 'FILE', help = 'set log filename, if not given log to STDOUT')
+  return argument_parser.parse_args()
 
-log.init_logging(None, logging.INFO)
+def export(args, verbose = True):
+  """ returns статистику прогона: файлы, записи, время этапов """
+  started = time.perf_counter()
+  if not os.path.lexists(args.output):
+    os.mkdir(args.output)
 
-json_configurations = []
+  #каждый pdf конвертируется и разбирается один раз, записи попадают в набор данных экспорта,
+  #а линии квитанции (если указаны хранилища) - в месячные файлы подходящего хранилища
+  dataset_sink = pipeline.DatasetSink(args.conf)
+  sinks = [dataset_sink]
+  if (not args.storages is None) and (args.bench is None):
+    sinks.append(pipeline.StorageSink(storage.load_storages(args.storages)))
+  p = pipeline.Pipeline(sinks, args.jobs, args.pages_per_job)
 
-for name in ['schema-receipt.json', 'schema-complete-renovation.json']:
-  json_configuration_filename = os.path.join('conf', name)
-  json_configurations.append(tsv.load_json_configuration(json_configuration_filename))
+  output_csv_filename = os.path.join(args.output, 'receipt.csv.gz')
+  output_dataset_filename = os.path.join(args.output, 'receipt.parquet')
 
-output_csv_filename = os.path.join(OUTPUT_DIR, 'receipt.csv.gz')
+  #распознанные файлы хранятся один раз, а имена <id>_<YYYY-MM>.pdf являются ссылками
+  archive = pdf_archive.PdfArchive(args.output)
 
-series = []
-for filename in sorted(glob.glob(os.path.join('input', '*.pdf'))):
-  o = pdf_utils.pdt_to_temporary_tsv(filename)
-  if o is None:
-    logging.error("Could not convert '%s' to TSV", filename)
-    continue
-  k = [j for j in json_configurations if os.path.basename(filename).startswith(j['id'])]
-  if len(k) == 1:
-    #в имени файла указан тип квитанции
-    s = tsv.read_and_parse(o, k[0])
-    assert(len(s) > 0)
-    series.extend(s)
-  else:
-    #пытаемся угадать тип квитанции и если получилось также копируем файл с указанием даты и типа квитанции
-    copy_filename = None
-    for j in json_configurations:
-      s = tsv.read_and_parse(o, j)
-      if len(s) > 0:
-        series.extend(s)
-        dt = s[0]['date']
-        copy_filename = os.path.join(OUTPUT_DIR, j['id'] + '_' + dt.strftime('%Y-%m') + '.pdf')
-        ok = True
-        break
-    if copy_filename is None:
+  filenames = sorted(glob.glob(os.path.join(args.input, '*.pdf')))
+  for filename in filenames:
+    results = p.process(filename)
+    if results is None:
+      continue
+    r = results[0]
+    if r is None:
       logging.error("Could not parse '%s'", filename)
       sys.exit(1)
-    shutil.copy2(filename, copy_filename)
-  os.unlink(o)
+    j, s = r
+    if not os.path.basename(filename).startswith(j['id']):
+      #тип квитанции угадан, поэтому также сохраняем файл с указанием даты и типа квитанции
+      archive.add(filename, j['id'] + '_' + s[0]['date'].strftime('%Y-%m') + '.pdf')
+
+  archive.save()
+  dataset_sink.save_templates()
+
+  t = time.perf_counter()
+  series = dataset_sink.series
+  timings = dict(p.timings)
+  stats = { 'files': len(filenames), 'records': len(series), 'timings': timings }
+  if len(series) == 0:
+    logging.warning(f'No receipts were recognized in "{args.input}"')
+    stats['seconds'] = time.perf_counter() - started
+    return stats
+  df = pd.DataFrame.from_records(series).sort_values(by = 'date', kind='mergesort')
+  if verbose:
+    print(df)
+  dataset.write_csv_gz(df, output_csv_filename, args.compress_level, args.jobs)
+  #типизированный набор данных для отчетов (dataset.load)
+  dataset.save(df, output_dataset_filename)
+  timings['write'] = time.perf_counter() - t
+  stats['seconds'] = time.perf_counter() - started
+  return stats
+
+def bench(args):
+  totals = { 'files': 0, 'records': 0, 'seconds': 0.0, 'timings': {} }
+  for i in range(args.bench):
+    d = export(args, verbose = False)
+    print(f'run {i+1}/{args.bench}: {d["files"]} files, {d["records"]} records, {d["seconds"]:.3f}s')
+    for k in ['files', 'records', 'seconds']:
+      totals[k] += d[k]
+    for k, v in d['timings'].items():
+      totals['timings'][k] = totals['timings'].get(k, 0.0) + v
+  elapsed = totals['seconds']
+  print(f'runs: {args.bench}, files: {totals["files"]}, records: {totals["records"]}, time: {elapsed:.3f}s')
+  if elapsed > 0:
+    print(f'files/sec: {totals["files"] / elapsed:.2f}, records/sec: {totals["records"] / elapsed:.1f}')
+  for k, v in totals['timings'].items():
+    share = 100.0 * v / elapsed if elapsed > 0 else 0.0
+    print(f'  {k:8s} {v:9.3f}s {share:5.1f}%')
+  rss = perf.peak_rss()
+  if not rss is None:
+    print(f'peak RSS: {rss[0] / (1 << 20):.1f} MiB, child processes: {rss[1] / (1 << 20):.1f} MiB')
+  print(f'conversion: {pdf_utils.CONVERTER.stats()}')
+
+def main():
+  args = parse_options()
+  #в режиме замеров журнал по каждому файлу не выводится
+  log.init_logging(args.log, logging.INFO if args.bench is None else logging.WARNING)
+  #файлы, которые pdftotext повторно не может сконвертировать, откладываются и не тормозят следующие запуски
+  pdf_utils.CONVERTER = pdf_utils.Converter(quarantine_dir = os.path.join(args.output, 'quarantine'))
+  if args.bench is None:
+    export(args)
+    logging.info('Conversion stats: %s', pdf_utils.CONVERTER.stats())
+  else:
+    bench(args)
 
-df = pd.DataFrame.from_records(series).sort_values(by = 'date', kind='mergesort')
-print(df)
-df.to_csv(output_csv_filename, compression={'method': 'gzip', 'compresslevel': 9}, index = False)
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+# -*- coding: UTF8 -*-
+"""
+ingest-daemon.py DROP_DIR
+загружает pdf квитанции, появляющиеся в папке, в хранилища месячных csv файлов
+"""
+import argparse
+import logging
+import os
+import signal
+import sys
+
+PROJECT_PATH = os.path.dirname(os.path.abspath(__file__))
+SOURCE_PATH = os.path.join(PROJECT_PATH, "src")
+sys.path.append(SOURCE_PATH)
+
+import ingest
+import log
+import pdf_utils
+import storage
+
+def parse_options():
+  argument_parser = argparse.ArgumentParser(description = 'Watches folder and ingests PDF receipts into storages')
+  argument_parser.add_argument('--storages', default = SOURCE_PATH, metavar = 'DIR', help = 'folder with storages json files')
+  argument_parser.add_argument('--workers', type = int, default = 2, help = 'number of conversion threads')
+  argument_parser.add_argument('--queue-size', type = int, default = 16, help = 'maximal number of queued files')
+  argument_parser.add_argument('--interval', type = float, default = 5.0, metavar = 'SECONDS', help = 'polling interval')
+  argument_parser.add_argument('--timeout', type = float, default = pdf_utils.TIMEOUT, metavar = 'SECONDS', help = 'pdftotext timeout')
+  argument_parser.add_argument('--quarantine', metavar = 'DIR', help = 'folder for PDF files which repeatedly fail to convert (default: DROP_DIR/quarantine)')
+  argument_parser.add_argument('--stats', metavar = 'FILE', help = 'write throughput and queue depth statistics in json format')
+  argument_parser.add_argument('--once', action = 'store_true', help = 'ingest current files and exit')
+  argument_parser.add_argument('-l', '--log', metavar = 'FILE', help = 'set log filename, if not given log to STDOUT')
+  argument_parser.add_argument('drop_dir')
+  return argument_parser.parse_args()
+
+def main():
+  args = parse_options()
+  log.init_logging(args.log, logging.INFO)
+  quarantine_dir = os.path.join(args.drop_dir, 'quarantine') if args.quarantine is None else args.quarantine
+  pdf_utils.CONVERTER = pdf_utils.Converter(timeout = args.timeout, quarantine_dir = quarantine_dir)
+  storages = storage.load_storages(args.storages)
+  if len(storages) == 0:
+    sys.exit(1)
+  ingester = ingest.Ingester(args.drop_dir, storages, args.workers, args.queue_size, args.interval)
+  signal.signal(signal.SIGINT, lambda signum, frame: ingester.stop())
+  signal.signal(signal.SIGTERM, lambda signum, frame: ingester.stop())
+  ingester.run(args.once, args.stats)
+
+if __name__ == '__main__':
+  main()
@@ -5,7 +5,6 @@ import sys
 import glob
 import datetime
 
-import pandas as pd
 import matplotlib.pyplot as plt
 import plotly.express as px
 import plotly.io as pio
@@ -14,15 +13,21 @@ PROJECT_PATH = os.getcwd()
 SOURCE_PATH = os.path.join(PROJECT_PATH, "src")
 sys.path.append(SOURCE_PATH)
 
+import dataset
 import log
 import pdf_utils
 import tsv
 
 OUTPUT_DIR = 'output'
 
-df = pd.read_csv(os.path.join(OUTPUT_DIR, 'receipt.csv.gz'), compression='gzip')
+try:
+  df = dataset.load(os.path.join(OUTPUT_DIR, 'receipt.parquet'))
+except FileNotFoundError:
+  #вывод export-receipt.py предыдущих версий
+  df = dataset.load(os.path.join(OUTPUT_DIR, 'receipt.csv.gz'))
+df['date'] = df['date'].dt.to_timestamp()
 h = []
-for name in df['row'].unique():  
+for name in df['row'].unique():
   f = df[(df['row'] == name) & (df['col'] == 'amount')][['date','value']]
   logging.info('Plot graph for %s', name)
   figure = px.bar(f, x='date', y='value')
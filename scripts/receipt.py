@@ -47,7 +47,7 @@ def main():
   if pdf_utils.pdf_to_tsv(args.input_filename, args.tmp_tsv) != 0:
     logging.critical(f'Can not convert "{args.input_filename}" PDF file to TSV format.')
     sys.exit(1)
-  rl = tsv.read_and_parse(args.tmp_tsv)
+  rl = tsv.read_receipt_lines([args.tmp_tsv])
   if args.output is None:
     d = rl.first_strdate()
     if d is None:
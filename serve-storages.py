@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+# -*- coding: UTF8 -*-
+"""
+serve-storages.py [--port PORT]
+локальный http/json сервис только для чтения данных хранилищ (см. src/query_service.py)
+"""
+import argparse
+import logging
+import os
+import sys
+
+PROJECT_PATH = os.path.dirname(os.path.abspath(__file__))
+SOURCE_PATH = os.path.join(PROJECT_PATH, "src")
+sys.path.append(SOURCE_PATH)
+
+import log
+import query_service
+import storage
+
+def parse_options():
+  argument_parser = argparse.ArgumentParser(description = 'Read-only HTTP/JSON service over storages')
+  argument_parser.add_argument('--storages', default = SOURCE_PATH, metavar = 'DIR', help = 'folder with storages json files')
+  argument_parser.add_argument('--host', default = '127.0.0.1', help = 'address to listen')
+  argument_parser.add_argument('--port', type = int, default = 8000, help = 'port to listen')
+  argument_parser.add_argument('-l', '--log', metavar = 'FILE', help = 'set log filename, if not given log to STDOUT')
+  return argument_parser.parse_args()
+
+def main():
+  args = parse_options()
+  log.init_logging(args.log, logging.INFO)
+  storages = storage.load_storages(args.storages)
+  if len(storages) == 0:
+    sys.exit(1)
+  query_service.serve(storages, args.host, args.port)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,123 @@
+# -*- coding: UTF8 -*-
+"""
+проверка согласованности извлеченных чисел по соотношениям столбцов, заданным в схеме ключом "checks":
+  "checks": [ "сумма + перерасч. = начислено", "сумма ≈ размер платы * норматив/расход(инд.)" ]
+операции + - * отделяются пробелами, '=' - равенство с точностью до копейки,
+'≈' - равенство с относительной точностью RELATIVE_TOLERANCE;
+соотношения вычисляются сразу для всех строк и месяцев над массивами строки × месяцы × столбцы,
+ячейки без данных (NaN) не проверяются
+"""
+
+import logging
+import re
+import time
+
+import numpy as np
+
+ABSOLUTE_TOLERANCE = 0.01
+RELATIVE_TOLERANCE = 0.02
+
+class Check:
+  """
+  >>> c = Check('c + b = a', ['a', 'b', 'c'])
+  >>> v = np.array([[[3.0, 1.0, 2.0], [3.0, 1.0, 1.0]]])
+  >>> c.violations(v).tolist()
+  [[False, True]]
+  >>> Check('a ≈ b * c', ['a', 'b', 'c']).violations(np.array([[[2.02, 1.0, 2.0], [np.nan, 1.0, 2.0]]])).tolist()
+  [[False, False]]
+  """
+  def __init__(self, expression: str, columns_names: list[str]):
+    self.expression = expression
+    m = re.fullmatch(r'(.+?) (=|≈) (.+)', expression.strip())
+    if m is None:
+      raise ValueError(f'check "{expression}" must contain " = " or " ≈ "')
+    self.approximate = m.group(2) == '≈'
+    self._index = { name: i for i, name in enumerate(columns_names) }
+    self._lhs = self._parse_sum(m.group(1))
+    self._rhs = self._parse_sum(m.group(3))
+  def _column(self, name):
+    i = self._index.get(name)
+    if i is None:
+      raise ValueError(f'unknown column "{name}" in check "{self.expression}"')
+    return i
+  def _parse_sum(self, s):
+    """ список (знак, номера перемножаемых столбцов) """
+    tokens = re.split(r' ([+-]) ', s)
+    terms = [(1.0, tokens[0])] + [(1.0 if op == '+' else -1.0, t) for op, t in zip(tokens[1::2], tokens[2::2])]
+    return [(sign, [self._column(name) for name in t.split(' * ')]) for sign, t in terms]
+  @staticmethod
+  def _evaluate(terms, values):
+    r = np.zeros(values.shape[:-1])
+    for sign, cols in terms:
+      p = values[..., cols[0]]
+      for c in cols[1:]:
+        p = p * values[..., c]
+      r += sign * p
+    return r
+  def evaluate(self, values):
+    """ returns (левая часть, правая часть) для массива строки × месяцы × столбцы """
+    return (self._evaluate(self._lhs, values), self._evaluate(self._rhs, values))
+  def violations(self, values):
+    lhs, rhs = self.evaluate(values)
+    tol = ABSOLUTE_TOLERANCE
+    if self.approximate:
+      tol = np.maximum(tol, RELATIVE_TOLERANCE * np.maximum(np.abs(lhs), np.abs(rhs)))
+    with np.errstate(invalid = 'ignore'):
+      return np.abs(lhs - rhs) > tol + 1e-9
+
+def audit(values, row_names, month_labels, checks, columns_names):
+  """
+  values - массив строки × месяцы × столбцы,
+  returns список нарушений (check, row, month, lhs, rhs)
+  """
+  a = []
+  for expression in checks:
+    c = Check(expression, columns_names)
+    mask = c.violations(values)
+    rows, months = np.nonzero(mask)
+    if len(rows) == 0:
+      continue
+    lhs, rhs = c.evaluate(values)
+    for r, m in zip(rows, months):
+      a.append({ 'check': expression, 'row': row_names[r], 'month': month_labels[m],
+                 'lhs': float(lhs[r, m]), 'rhs': float(rhs[r, m]) })
+  return a
+
+def audit_storage(s):
+  """ проверка всей истории хранилища storage.Storage """
+  t = time.perf_counter()
+  checks = s.schema.checks()
+  matrices = [(year, s.load_year_matrix(year)) for year in s.available_years()]
+  labels = [f'{year}-{month:02d}' for year, m in matrices for month in m.months]
+  res = []
+  if (len(labels) > 0) and (len(checks) > 0):
+    values = np.concatenate([m.values for _, m in matrices], axis = 1)
+    res = audit(values, [r[0] for r in s.schema.rows], labels, checks, s.schema.columns_names())
+  logging.info(f'Audit of "{s.schema.title()}": {len(labels)} months, {len(res)} violations, {time.perf_counter() - t:.3f}s')
+  return res
+
+def audit_dataset(df, configurations):
+  """
+  проверка набора данных экспорта (date, id, row, col, value) по соотношениям конфигураций,
+  configurations - список json конфигураций (tsv.load_json_configuration)
+  """
+  t = time.perf_counter()
+  res = []
+  for c in configurations:
+    checks = c.get('checks', [])
+    f = df[df['id'] == c['id']] if 'id' in df.columns else df
+    if (len(checks) == 0) or (len(f) == 0):
+      continue
+    row_names = [r['name'] for r in c['rows']]
+    columns = c['columns']
+    wide = f.pivot_table(index = ['row', 'date'], columns = 'col', values = 'value', aggfunc = 'last', observed = True)
+    months = sorted(set(wide.index.get_level_values('date')))
+    full = wide.reindex(index = [(r, m) for r in row_names for m in months], columns = columns)
+    values = full.to_numpy(dtype = np.float64).reshape(len(row_names), len(months), len(columns))
+    res.extend(audit(values, row_names, list(map(str, months)), checks, columns))
+  logging.info(f'Audit of dataset: {len(df)} records, {len(res)} violations, {time.perf_counter() - t:.3f}s')
+  return res
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod(verbose=True)
@@ -0,0 +1,120 @@
+# -*- coding: UTF8 -*-
+"""
+набор данных экспорта квитанций в длинном формате (date, id, row, col, value)
+в компактном типизированном виде: категории вместо повторяющихся строк,
+float32 для значений и месячные периоды вместо дат
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import logging
+import os
+import time
+
+import pandas as pd
+
+CATEGORY_COLUMNS = ['id', 'row', 'col']
+
+def to_compact(df: pd.DataFrame) -> pd.DataFrame:
+  d = {}
+  for c in CATEGORY_COLUMNS:
+    if c in df.columns:
+      d[c] = df[c].astype('category')
+  if 'value' in df.columns:
+    d['value'] = df['value'].astype('float32')
+  if ('date' in df.columns) and not isinstance(df['date'].dtype, pd.PeriodDtype):
+    d['date'] = pd.to_datetime(df['date']).dt.to_period('M')
+  return df.assign(**d)
+
+def _format(filename):
+  """
+  >>> _format('output/receipt.parquet'), _format('receipt.feather'), _format('receipt.csv.gz')
+  ('parquet', 'feather', 'csv')
+  """
+  ext = os.path.splitext(filename)[1]
+  if ext in ['.parquet', '.feather']:
+    return ext[1:]
+  return 'csv'
+
+def _csv_filename(filename):
+  """
+  запасной csv для parquet/feather без pyarrow, имя отличается от receipt.csv.gz,
+  который export-receipt.py пишет рядом (write_csv_gz)
+  >>> _csv_filename('output/receipt.parquet')
+  'output/receipt-dataset.csv.gz'
+  """
+  return os.path.splitext(filename)[0] + '-dataset.csv.gz'
+
+def save(df: pd.DataFrame, filename: str) -> str:
+  """
+  сохраняет набор данных в формате по расширению файла (.parquet, .feather или csv),
+  если pyarrow не установлен, то вместо parquet/feather пишется .csv.gz,
+  returns имя записанного файла
+  """
+  df = to_compact(df)
+  fmt = _format(filename)
+  if fmt != 'csv':
+    try:
+      if fmt == 'parquet':
+        df.to_parquet(filename, index = False)
+      else:
+        df.reset_index(drop = True).to_feather(filename)
+      return filename
+    except ImportError as err:
+      logging.warning(f'Can not write {fmt} file ({err}), please install pyarrow: pip3 install pyarrow')
+      filename = _csv_filename(filename)
+  df.assign(date = df['date'].astype(str)).to_csv(filename, index = False)
+  return filename
+
+def load(filename: str) -> pd.DataFrame:
+  """
+  загрузка набора данных любого из поддерживаемых форматов с восстановлением типов,
+  если parquet/feather файла нет, то читается запасной csv, который пишет save без pyarrow
+  """
+  fmt = _format(filename)
+  if (fmt != 'csv') and (not os.path.lexists(filename)):
+    csv_filename = _csv_filename(filename)
+    if not os.path.lexists(csv_filename):
+      raise FileNotFoundError(f'Neither "{filename}" nor "{csv_filename}" exists, run export-receipt.py first')
+    logging.info(f'"{filename}" is not found, loading "{csv_filename}"')
+    filename = csv_filename
+    fmt = 'csv'
+  if fmt == 'parquet':
+    return to_compact(pd.read_parquet(filename))
+  if fmt == 'feather':
+    return to_compact(pd.read_feather(filename))
+  dtype = { c: 'category' for c in CATEGORY_COLUMNS }
+  dtype['value'] = 'float32'
+  df = pd.read_csv(filename, dtype = dtype)
+  return df.assign(date = pd.PeriodIndex(df['date'].str.slice(0, 7), freq = 'M'))
+
+def write_csv_gz(df: pd.DataFrame, filename: str, compresslevel = 9, jobs = None, chunk_rows = 20000) -> dict:
+  """
+  запись csv со сжатием gzip в несколько потоков: кадр сериализуется частями,
+  каждая часть сжимается независимо в отдельный gzip member (как pigz),
+  результат читается обычным gzip и pandas,
+  returns статистику (размеры до и после сжатия, время, скорость в байтах в секунду)
+  """
+  def compress(start):
+    chunk = df.iloc[start:start + chunk_rows].to_csv(index = False, header = start == 0)
+    b = chunk.encode('UTF8')
+    return (len(b), gzip.compress(b, compresslevel = compresslevel, mtime = 0))
+  t = time.perf_counter()
+  raw_bytes = 0
+  compressed_bytes = 0
+  starts = range(0, max(len(df), 1), chunk_rows)
+  with open(filename, 'wb') as f, ThreadPoolExecutor(max_workers = jobs) as executor:
+    for n, b in executor.map(compress, starts):
+      raw_bytes += n
+      compressed_bytes += len(b)
+      f.write(b)
+  elapsed = time.perf_counter() - t
+  d = { 'raw_bytes': raw_bytes, 'compressed_bytes': compressed_bytes, 'chunks': len(starts), 'seconds': elapsed,
+        'bytes_per_sec': raw_bytes / elapsed if elapsed > 0 else 0.0 }
+  logging.info(f'"{filename}": {raw_bytes} bytes compressed to {compressed_bytes} bytes (level {compresslevel}) '
+               f'in {elapsed:.3f}s, {d["bytes_per_sec"] / 1e6:.1f} MB/s')
+  return d
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod(verbose=True)
@@ -1,7 +1,8 @@
 #!/usr/bin/python
+from collections import OrderedDict
 import logging
-import os
 import sys
+import threading
 import tkinter as tk
 from tkinter import ttk
 from tkinter import messagebox
@@ -11,16 +12,16 @@ import tkinter.font as tkFont
 import git
 import io_utils
 import log
-import pdf_utils
+import perf
+import pipeline
 import storage
+import storage_registry
 import tsv
 
-def float_value(s):
-  if s == '?':
-    return None
-  if (s == '-') or (s == '') or (s == '?'):
-    return 0.0
-  return float(s.replace(',', '.'))
+#при большем количестве хранилищ вместо пунктов меню используется диалог с поиском
+MENU_STORAGES_LIMIT = 20
+#количество годов (всех хранилищ), которые держит в памяти YearPrefetcher
+PREFETCH_CACHE_SIZE = 12
 
 def remove_all_widgets_from_frame(frame):
   """
@@ -29,11 +30,20 @@ def remove_all_widgets_from_frame(frame):
   for widget in frame.winfo_children():
     widget.destroy()
 
+def count_widgets(widget):
+  return 1 + sum(map(count_widgets, widget.winfo_children()))
+
 def _tip(window, hint):
   """ https://stackoverflow.com/a/65125558/14024582 """
   from idlelib.tooltip import Hovertip
   tip = Hovertip(window, hint)
 
+def _rollup_hint(r: storage.YearRollup, i: int, columns_names: list[str]):
+  """ подсказка к названию строки с годовыми итогами по столбцам """
+  a = [f'{name}: сумма {r.sum[i, j]:.2f}, мин. {r.min[i, j]:.2f}, макс. {r.max[i, j]:.2f}, месяцев {r.count[i, j]}'
+       for j, name in enumerate(columns_names) if r.count[i, j] > 0]
+  return '\n'.join(a) if len(a) > 0 else None
+
 def _create_label(parent, text, fg = None, font = None, hint = None):
   d = { 'text': text, 'anchor': tk.CENTER, 'justify': tk.CENTER}
   if not fg is None:
@@ -45,6 +55,74 @@ def _create_label(parent, text, fg = None, font = None, hint = None):
     _tip(label, hint)
   return label
 
+class YearPrefetcher:
+  """
+  ограниченный кеш загруженных годов (YearMatrix и YearRollup), который после показа таблицы
+  заполняется в фоновом потоке соседними годами и текущим годом других открытых хранилищ,
+  запись кеша действительна, пока не изменился манифест хранилища (storage.Storage.data_version),
+  Storage не рассчитан на одновременное использование из нескольких потоков,
+  поэтому все обращения к хранилищу выполняются под его блокировкой (storage_lock)
+  """
+  def __init__(self, max_entries = PREFETCH_CACHE_SIZE):
+    self.max_entries = max_entries
+    #(json файл хранилища, year) -> (версия данных, (YearMatrix, YearRollup))
+    self._cache = OrderedDict()
+    self._storage_locks = {}
+    self._pending = []
+    self._lock = threading.Lock()
+    self._wakeup = threading.Condition(self._lock)
+    self._thread = threading.Thread(target = self._run, daemon = True)
+    self._thread.start()
+  def storage_lock(self, s: storage.Storage):
+    with self._lock:
+      return self._storage_locks.setdefault(s.schema_filename, threading.Lock())
+  def _load(self, s, year):
+    """ вызывается под блокировкой хранилища, returns (YearMatrix, YearRollup, загружено из кеша) """
+    key = (s.schema_filename, year)
+    version = s.data_version()
+    with self._lock:
+      e = self._cache.get(key)
+      if (not e is None) and (e[0] == version):
+        self._cache.move_to_end(key)
+        return e[1] + (True,)
+    d = (s.load_year_matrix(year), s.year_rollup(year))
+    #если другой процесс записал данные во время загрузки, то год мог загрузиться частично обновленным,
+    #такой результат показывается, но не кешируется
+    loaded_version = s.data_version()
+    with self._lock:
+      if loaded_version == version:
+        self._cache[key] = (version, d)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+          self._cache.popitem(last = False)
+      else:
+        self._cache.pop(key, None)
+    return d + (False,)
+  def load(self, s: storage.Storage, year: int):
+    """ returns (YearMatrix, YearRollup) из кеша или загруженные сейчас """
+    with self.storage_lock(s):
+      m, r, hit = self._load(s, year)
+    perf.PROFILER.counter('prefetch_hit', int(hit))
+    return (m, r)
+  def schedule(self, items):
+    """ заменяет очередь фоновой загрузки списком пар (хранилище, год) """
+    with self._lock:
+      self._pending = list(items)
+      self._wakeup.notify()
+  def _run(self):
+    while True:
+      with self._lock:
+        while len(self._pending) == 0:
+          self._wakeup.wait()
+        s, year = self._pending.pop(0)
+      try:
+        with self.storage_lock(s):
+          if year in s.available_years():
+            with perf.PROFILER.span('prefetch_year'):
+              self._load(s, year)
+      except Exception as err:
+        logging.exception(f'Prefetch of {year} year failed: {err}')
+
 class BrowsableGridTable:
   """ таблица с разделителями,
       фиксированными столбцами описания,
@@ -60,6 +138,7 @@ class BrowsableGridTable:
     label.grid(**d)
   def is_empty(self):
     return len(self._months) == 0
+  @perf.timed('scrollable_area_window_change_visibility')
   def scrollable_area_window_change_visibility(self, show = True):
     if self.is_empty():
       return
@@ -97,6 +176,7 @@ class BrowsableGridTable:
           v = max(v, w)
       a.append(v + 4)
     return a
+  @perf.timed('_compute_best_max_month')
   def _compute_best_max_month(self, tot_months, max_width):
     w = self._compute_columns_width()
     w01 = w[0] + w[1]
@@ -126,34 +206,37 @@ class BrowsableGridTable:
       if (c >= 2) and ((c - 2) % self._col_per_month != 0):
         rowspan -= 2
       sep.grid(row = 0, column = col, rowspan = rowspan, sticky = tk.N + tk.S)
-  def _create_labels(self, s: storage.Storage, months: list[int], data: list[list[int]]):
+  @perf.timed('_create_labels')
+  def _create_labels(self, s: storage.Storage, months: list[int], data: list[list[str]], mom, rollup):
     """не зависит от количества видимых столбцов"""
+    columns_names = s.schema.columns_names()
     self._labels = [ [None] * self._col_count for _ in range(self._row_count)]
     normal_font = tkFont.Font(family = 'Times', size = 11, slant = tkFont.ROMAN)
     bold_font = tkFont.Font(family = 'Times', size = 11, weight = tkFont.BOLD, slant = tkFont.ROMAN)
     for i, (n, v) in enumerate(zip(s.schema.rows, data)):
       rl = self._labels[i+1]
-      rl[0] = _create_label(self._parent, n[0], font = normal_font)
+      hint = _rollup_hint(rollup, i, columns_names)
+      if not hint is None:
+        self.hovertips += 1
+      rl[0] = _create_label(self._parent, n[0], font = normal_font, hint = hint)
       self._add_label_to_grid(rl[0], i+1, 0)
       rl[1] = _create_label(self._parent, n[1], font = bold_font)
       self._add_label_to_grid(rl[1], i+1, 1)
       for j, p in enumerate(v):
         fg = None
         hint = None
-        c = float_value(p)
-        if c is None:
+        if p == '?':
           fg = "gray"
           hint = "нет данных в квитанции"
-        elif j >= self._col_per_month:
-          c2 = float_value(v[j-self._col_per_month])
-          if not c2 is None:
-            c -= c2
-            if c > 1e-6:
-              #increase
-              fg = "red"
-            if c < -1e-6:
-              #decrease
-              fg = "green"
+          self.hovertips += 1
+        else:
+          c = mom[i, j // self._col_per_month, j % self._col_per_month]
+          if c > 1e-6:
+            #increase
+            fg = "red"
+          if c < -1e-6:
+            #decrease
+            fg = "green"
         rl[j+2] = _create_label(self._parent, p, fg, normal_font, hint)
     rl = self._labels[0]
     rl[1] = _create_label(self._parent, 'ед.изм.', font = normal_font)
@@ -161,15 +244,16 @@ class BrowsableGridTable:
     rl = self._labels[self._row_count - 1]
     for j, month in enumerate(months):
       rl[2 + j * self._col_per_month] = _create_label(self._parent, tsv.get_month_by_id(month), font = normal_font)
-    columns_names = s.schema.columns_names()
     rl = self._labels[0]
     for j in range(self._col_per_month * len(months)):
       rl[j+2] = _create_label(self._parent, columns_names[j % self._col_per_month], font = normal_font)
       #self._add_label_to_grid(rl[j+2], 0, j+2)
-  def __init__(self, frame: tk.Frame, s: storage.Storage, year: int, max_width: int):
+  def __init__(self, frame: tk.Frame, s: storage.Storage, year: int, max_width: int, prefetcher: YearPrefetcher):
     #max_width = frame.winfo_width()
-    months, data = s.load_year_data(year)
+    m, rollup = prefetcher.load(s, year)
+    months, data = m.months, m.data
     self._parent = frame
+    self.hovertips = 0
     self._months = months
     self._data = data
     self._max_width = max_width
@@ -181,7 +265,7 @@ class BrowsableGridTable:
     self._row_count = 2 + len(data)
     self._col_count = 2 + len(data[0])
     self._month_label_colspan = 2 * self._col_per_month - 1
-    self._create_labels(s, months, data)
+    self._create_labels(s, months, data, m.mom, rollup)
 
     self._compute_best_max_month(tot_months, max_width)
     self._first_month = 0
@@ -192,23 +276,26 @@ class BrowsableGridTable:
     self.scrollable_area_window_change_visibility(True)
 
 class MainWindow:
-  def __init__(self, root, db_storages: list[storage.Storage], min_width = 1600, min_height = 900):
+  def __init__(self, root, registry: storage_registry.StorageRegistry, db_storage: storage.Storage,
+               min_width = 1600, min_height = 900):
     self.root = root
     self.root.minsize(width=min_width, height=min_height)
     self._width = 0
     self._min_width = min_width
-    self.db_storages = db_storages
-    self.db_storage = db_storages[0]
+    self.registry = registry
+    self.db_storage = db_storage
     self.table = None
     self._year = 0
     self.current_year = None
     self.year_combobox = None
+    self.prefetcher = YearPrefetcher()
     self.root.title(f'Receipt-{git.hash_version()}')
     self._create_menubar()
     self._create_table_frame()
     self._create_frame_with_buttons()
     self._pack_widgets()
     self.bind_config()
+    perf.PROFILER.start_heartbeat(self.root)
   def bind_config(self):
     self.root.bind("<Configure>", self.resize)
   def resize(self, event):
@@ -218,9 +305,10 @@ class MainWindow:
       self.reload_table()
   def _change_current_storage(self):
     idx = self.current_storage_index.get()
-    if 0 <= idx < len(self.db_storages):
-      if self.db_storages[idx] != self.db_storage:
-        self.db_storage = self.db_storages[idx]
+    if 0 <= idx < len(self.registry):
+      s = self.registry.open(idx)
+      if (not s is None) and (s != self.db_storage):
+        self.db_storage = s
         self.reload_combobox()
         self.reload_table()
   def _create_menubar(self):
@@ -232,14 +320,47 @@ class MainWindow:
     base_menu.add_separator()
     self.current_storage_index = tk.IntVar(base_menu, 0)
     self.current_storage_index.trace("w", lambda varname, _, operation: self._change_current_storage())
-    for i, s in enumerate(self.db_storages):
-      base_menu.add_radiobutton(label = s.schema.title(), value = i, variable = self.current_storage_index)
+    if len(self.registry) > MENU_STORAGES_LIMIT:
+      base_menu.add_command(label="Выбрать базу...", command=self._choose_storage)
+      return
+    for i, title in enumerate(self.registry.titles()):
+      base_menu.add_radiobutton(label = title, value = i, variable = self.current_storage_index)
+  def _choose_storage(self):
+    """ диалог выбора хранилища с поиском по названию """
+    dialog = tk.Toplevel(self.root)
+    dialog.title('Выбор базы')
+    text = tk.StringVar(dialog)
+    entry = tk.Entry(dialog, textvariable = text, width = 60)
+    entry.pack(side = tk.TOP, fill = tk.X)
+    listbox = tk.Listbox(dialog, height = 20)
+    listbox.pack(side = tk.TOP, fill = tk.BOTH, expand = True)
+    found = []
+    def update_list():
+      found[:] = self.registry.search(text.get())
+      listbox.delete(0, tk.END)
+      for i in found:
+        listbox.insert(tk.END, self.registry.title(i))
+    def select(_event = None):
+      sel = listbox.curselection()
+      if len(sel) == 0:
+        if len(found) != 1:
+          return
+        sel = (0,)
+      self.current_storage_index.set(found[sel[0]])
+      dialog.destroy()
+    text.trace("w", lambda varname, _, operation: update_list())
+    listbox.bind('<Double-Button-1>', select)
+    listbox.bind('<Return>', select)
+    entry.bind('<Return>', select)
+    update_list()
+    entry.focus_set()
   def _create_table_frame(self):
     self.table_frame = tk.Frame(self.root)
     #self.table = tk.Frame(self.root, bd = 10, relief = tk.SUNKEN)
     #self.table_frame.columnconfigure(0, weight=1)
   def reload_combobox(self):
-    years = list(map(str, self.db_storage.available_years()))
+    with self.prefetcher.storage_lock(self.db_storage):
+      years = list(map(str, self.db_storage.available_years()))
     self.year_combobox['values'] = years
     if self._year == 0:
       last_year = None
@@ -269,6 +390,10 @@ class MainWindow:
     self.button_back.pack(side = tk.LEFT)
     self._create_year_combobox()
     self.year_combobox.pack(side = tk.LEFT)
+    self.perf_label = None
+    if perf.PROFILER.enabled():
+      self.perf_label = tk.Label(self.frame_with_buttons, fg = 'gray')
+      self.perf_label.pack(side = tk.LEFT)
   def _pack_widgets(self):
     #self.year_combobox.pack()
     self.frame_with_buttons.pack(side = tk.TOP)
@@ -291,31 +416,42 @@ class MainWindow:
     label.grid(**d)
     return label
   def reload_table(self):
-    remove_all_widgets_from_frame(self.table_frame)
-    max_width = self.root.winfo_width()
-    logging.debug(f'reload_table(): max_width = {max_width}')
-    self.table = BrowsableGridTable(self.table_frame, self.db_storage, self._year, max_width)
+    with perf.PROFILER.span('reload_table'):
+      remove_all_widgets_from_frame(self.table_frame)
+      max_width = self.root.winfo_width()
+      logging.debug(f'reload_table(): max_width = {max_width}')
+      self.table = BrowsableGridTable(self.table_frame, self.db_storage, self._year, max_width, self.prefetcher)
+    self._update_perf_overlay()
+    #пока пользователь смотрит на таблицу, загружаются годы, на которые он скорее всего переключится
+    others = [(s, self._year) for s in self.registry.open_storages() if s != self.db_storage]
+    self.prefetcher.schedule([(self.db_storage, self._year - 1), (self.db_storage, self._year + 1)] + others)
+  def _update_perf_overlay(self):
+    p = perf.PROFILER
+    if not p.enabled():
+      return
+    p.counter('widgets', count_widgets(self.root))
+    p.counter('hovertips', self.table.hovertips)
+    last = p.last
+    self.perf_label['text'] = (f"reload {last.get('reload_table', 0.0) * 1e3:.0f} ms, "
+                               f"widgets {last.get('widgets', 0)}, hovertips {last.get('hovertips', 0)}, "
+                               f"latency {last.get('event_loop_latency_ms', 0.0):.0f} ms")
   def set_year(self, year):
     if self._year != year:
       logging.debug(f'Modifing current year to {year}')
       self._year = year
       self.reload_table()
   def _add_pdf_file(self, pdf_filename):
-    tmp_tsv = io_utils.temporary_filename('out.tsv')
-    if pdf_utils.pdf_to_tsv(pdf_filename, tmp_tsv) != 0:
+    with self.prefetcher.storage_lock(self.db_storage):
+      results = pipeline.Pipeline([pipeline.StorageSink([self.db_storage])]).process(pdf_filename)
+    if results is None:
       logging.error(f'Can not convert "{pdf_filename}" PDF file to TSV format.')
       return
-    rl = tsv.read_and_parse(tmp_tsv)
-    date = rl.first_date
-    if not date is None:
-      year, month = date
-      flags = self.db_storage.save_csv(year, month, rl)
+    if not results[0] is None:
+      _, flags = results[0]
       if (flags & storage.FLAG_NEW_YEAR) != 0:
         self.reload_combobox()
       if (flags & storage.FLAG_NEW_MONTH) != 0:
         self.reload_table()
-    logging.info(f'Removing temp file "{tmp_tsv}"')
-    os.unlink(tmp_tsv)
   def add_pdf_files(self):
     logging.info("Clicked add_pdf_file")
     input_filenames = fd.askopenfilenames(
@@ -325,15 +461,22 @@ class MainWindow:
       self._add_pdf_file(pdf_filename)
   def mainloop(self):
     self.root.mainloop()
+    perf.PROFILER.save()
 
 def main():
   log.init_logging('out.log', logging.DEBUG)
   dirname = io_utils.script_dirname()
-  storages = storage.load_storages(dirname)
-  if len(storages) == 0:
+  registry = storage_registry.StorageRegistry(dirname)
+  db_storage = None
+  for i in range(len(registry)):
+    db_storage = registry.open(i)
+    if not db_storage is None:
+      break
+  if db_storage is None:
     messagebox.showerror("Ошибка", f'Не найдено ни одного правильного файла конфигурации в json формате в папке "{dirname}"')
     sys.exit(1)
-  window = MainWindow(tk.Tk(), storages)
+  window = MainWindow(tk.Tk(), registry, db_storage)
+  window.current_storage_index.set(i)
   window.mainloop()
 
 main()
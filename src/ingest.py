@@ -0,0 +1,216 @@
+# -*- coding: UTF8 -*-
+"""
+фоновая загрузка pdf квитанций из папки в хранилища (storage.Storage)
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import io_utils
+import pdf_utils
+import pipeline
+import storage
+
+STATE_FILENAME = '.ingested.json'
+#пауза перед повторной попыткой загрузить файл, который не удалось обработать, удваивается после каждой неудачи
+RETRY_DELAY = 60.0
+RETRY_MAX_DELAY = 3600.0
+
+class Ingester:
+  """
+  опрашивает папку drop_dir, отбрасывает уже загруженные файлы по sha256 содержимого,
+  ставит новые pdf в ограниченную очередь, которую разбирает пул потоков
+  (файлы, которые не удалось загрузить, повторяются с нарастающей паузой),
+  каждая квитанция сохраняется в хранилище, схема которого лучше всего подходит,
+  и передается дополнительным приемникам sinks (например pipeline.DatasetSink) без повторного разбора
+  >>> import tempfile
+  >>> d = tempfile.TemporaryDirectory()
+  >>> for name in ['a.pdf', 'copy-of-a.pdf']:
+  ...   with open(os.path.join(d.name, name), 'wb') as f:
+  ...     f.write(b'receipt')
+  7
+  7
+  >>> i = Ingester(d.name, [], workers = 1)
+  >>> processed = []
+  >>> i.process = lambda fn: processed.append(os.path.basename(fn)) is None
+  >>> i.run(once = True)
+  >>> i.run(once = True)
+  >>> processed, i.stats()['duplicates'], list(i._load_state().values()) == [os.path.join(d.name, 'a.pdf')]
+  (['a.pdf'], 1, True)
+  >>> d.cleanup()
+  """
+  def __init__(self, drop_dir: str, storages: list[storage.Storage], workers = 2, queue_size = 16, poll_interval = 5.0,
+               sinks = None):
+    self.drop_dir = drop_dir
+    self.storages = storages
+    self.poll_interval = poll_interval
+    self._workers = workers
+    self._queue = queue.Queue(maxsize = queue_size)
+    self._state_filename = os.path.join(drop_dir, STATE_FILENAME)
+    #sha256 -> имя файла, уже загруженные в хранилища
+    self._ingested = self._load_state()
+    #путь -> (размер, mtime, sha256), чтобы не пересчитывать хеши при каждом опросе
+    self._digests = {}
+    #хеши файлов стоящих в очереди или обрабатываемых
+    self._pending = set()
+    #путь -> (размер, mtime) файлов, которые уже загружены или оказались дубликатами
+    self._seen = {}
+    #путь -> ((размер, mtime), число неудач, время следующей попытки) файлов, которые не удалось загрузить
+    self._failures = {}
+    self._lock = threading.Lock()
+    self._pipeline = pipeline.Pipeline([pipeline.StorageSink(storages)] + ([] if sinks is None else sinks))
+    self._stop = threading.Event()
+    self._threads = []
+    self._started = None
+    self._stats = { 'queued': 0, 'processed': 0, 'failed': 0, 'duplicates': 0, 'unrouted': 0 }
+  def _load_state(self):
+    if not os.path.lexists(self._state_filename):
+      return {}
+    with open(self._state_filename, 'r', encoding = 'UTF8') as f:
+      return json.load(f)
+  def _save_state(self):
+    tmp = self._state_filename + '.tmp'
+    with open(tmp, 'w', encoding = 'UTF8') as f:
+      json.dump(self._ingested, f, ensure_ascii = False)
+    os.replace(tmp, self._state_filename)
+  def _digest(self, filename, key):
+    t = self._digests.get(filename)
+    if (t is None) or (t[0] != key):
+      t = (key, io_utils.file_digest(filename))
+      self._digests[filename] = t
+    return t[1]
+  def scan(self):
+    """ ставит в очередь новые файлы, блокируется если очередь заполнена """
+    with os.scandir(self.drop_dir) as it:
+      filenames = sorted(e.path for e in it if e.is_file() and e.name.lower().endswith('.pdf'))
+    self._prune(filenames)
+    for fn in filenames:
+      if self._stop.is_set():
+        break
+      try:
+        st = os.stat(fn)
+        key = (st.st_size, st.st_mtime_ns)
+        with self._lock:
+          if self._seen.get(fn) == key:
+            continue
+          f = self._failures.get(fn)
+          if (not f is None) and (f[0] == key) and (time.monotonic() < f[2]):
+            continue
+        digest = self._digest(fn, key)
+      except OSError as err:
+        logging.warning(f'Can not read "{fn}": {err}')
+        continue
+      with self._lock:
+        if digest in self._pending:
+          #файл с тем же содержимым еще обрабатывается, решение примем при следующем опросе
+          continue
+        if digest in self._ingested:
+          self._seen[fn] = key
+          if self._ingested[digest] != fn:
+            self._stats['duplicates'] += 1
+            logging.info(f'Skip "{fn}", the same content is already ingested')
+          continue
+        self._pending.add(digest)
+        self._stats['queued'] += 1
+      self._queue.put((fn, key, digest))
+  def _prune(self, filenames):
+    """ забывает удаленные из папки файлы """
+    existing = set(filenames)
+    for fn in [fn for fn in self._digests if not fn in existing]:
+      del self._digests[fn]
+    with self._lock:
+      for d in [self._seen, self._failures]:
+        for fn in [fn for fn in d if not fn in existing]:
+          del d[fn]
+  def _failed(self, filename, key):
+    """ откладывает повторную попытку, файл с другим размером или mtime пробуется при следующем опросе """
+    f = self._failures.get(filename)
+    n = 1 if (f is None) or (f[0] != key) else f[1] + 1
+    delay = min(RETRY_DELAY * (1 << (n - 1)), RETRY_MAX_DELAY)
+    self._failures[filename] = (key, n, time.monotonic() + delay)
+    logging.warning(f'"{filename}" failed {n} time(s), next attempt in {delay:.0f}s')
+  def process(self, filename):
+    """ returns True, если квитанция сохранена в хранилище """
+    results = self._pipeline.process(filename)
+    if results is None:
+      logging.error(f'Can not convert "{filename}" PDF file to TSV format.')
+      return False
+    if results[0] is None:
+      with self._lock:
+        self._stats['unrouted'] += 1
+      return False
+    return True
+  def _worker(self):
+    while True:
+      item = self._queue.get()
+      if item is None:
+        self._queue.task_done()
+        break
+      fn, key, digest = item
+      try:
+        ok = self.process(fn)
+      except Exception as err:
+        logging.exception(f'Failed to ingest "{fn}": {err}')
+        ok = False
+      with self._lock:
+        self._pending.discard(digest)
+        if ok:
+          self._ingested[digest] = fn
+          self._seen[fn] = key
+          self._failures.pop(fn, None)
+          self._stats['processed'] += 1
+          self._save_state()
+        else:
+          self._failed(fn, key)
+          self._stats['failed'] += 1
+      self._queue.task_done()
+  def stats(self):
+    with self._lock:
+      d = dict(self._stats)
+    d['queue_depth'] = self._queue.qsize()
+    elapsed = 0.0 if self._started is None else time.monotonic() - self._started
+    d['elapsed'] = elapsed
+    d['files_per_sec'] = d['processed'] / elapsed if elapsed > 0 else 0.0
+    d['conversion'] = pdf_utils.CONVERTER.stats()
+    return d
+  def start(self):
+    self._started = time.monotonic()
+    for _ in range(self._workers):
+      t = threading.Thread(target = self._worker, daemon = True)
+      t.start()
+      self._threads.append(t)
+  def stop(self):
+    self._stop.set()
+  def join(self):
+    """ дождаться обработки очереди и остановить потоки """
+    for _ in self._threads:
+      self._queue.put(None)
+    for t in self._threads:
+      t.join()
+    self._threads = []
+  def run(self, once = False, stats_filename = None):
+    self.start()
+    try:
+      while not self._stop.is_set():
+        self.scan()
+        if once:
+          break
+        self._stop.wait(self.poll_interval)
+        self._report(stats_filename)
+    finally:
+      self.join()
+      self._report(stats_filename)
+  def _report(self, stats_filename):
+    d = self.stats()
+    logging.info('Ingest stats: %s', d)
+    if not stats_filename is None:
+      with open(stats_filename, 'w', encoding = 'UTF8') as f:
+        json.dump(d, f)
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod(verbose=True)
@@ -2,6 +2,7 @@
 """
 функции связанные с файловой системой и вводом/выводом
 """
+import hashlib
 import os
 import sys
 
@@ -21,3 +22,14 @@ def create_dir_if_absent(dirname):
 
 def temporary_filename(filename):
   return path_join(None, filename)
+
+def file_digest(filename, chunk_size = 1 << 20):
+  """ sha256 содержимого файла """
+  h = hashlib.sha256()
+  with open(filename, 'rb') as f:
+    while True:
+      b = f.read(chunk_size)
+      if not b:
+        break
+      h.update(b)
+  return h.hexdigest()
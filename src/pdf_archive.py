@@ -0,0 +1,113 @@
+# -*- coding: UTF8 -*-
+"""
+архив распознанных pdf файлов с адресацией по содержимому:
+каждый файл хранится один раз под своим sha256, а имена вида <id>_<YYYY-MM>.pdf
+являются жесткими (или символическими) ссылками на него
+"""
+
+import json
+import logging
+import os
+import shutil
+
+import io_utils
+
+OBJECTS_DIR = '.objects'
+INDEX_FILENAME = '.archive-index.json'
+
+class PdfArchive:
+  """
+  одинаковые файлы хранятся одним объектом, имя перепривязывается, если под ним добавлен другой файл
+  >>> import tempfile
+  >>> d = tempfile.TemporaryDirectory()
+  >>> def pdf(name, content):
+  ...   fn = os.path.join(d.name, name)
+  ...   with open(fn, 'wb') as f:
+  ...     _ = f.write(content)
+  ...   return fn
+  >>> a = PdfArchive(os.path.join(d.name, 'archive'))
+  >>> x = a.add(pdf('1.pdf', b'receipt 1'), 'r_2024-01.pdf')
+  >>> y = a.add(pdf('copy.pdf', b'receipt 1'), 'r_2024-02.pdf')
+  >>> os.path.samefile(x, y), len(os.listdir(os.path.join(a.root_dir, OBJECTS_DIR)))
+  (True, 1)
+  >>> z = a.add(pdf('2.pdf', b'receipt 2'), 'r_2024-02.pdf')
+  >>> os.path.samefile(x, z), len(set(a.names.values()))
+  (False, 2)
+  >>> a.save()
+  >>> PdfArchive(a.root_dir).names == a.names
+  True
+  >>> d.cleanup()
+  """
+  def __init__(self, root_dir):
+    self.root_dir = root_dir
+    self._objects_dir = os.path.join(root_dir, OBJECTS_DIR)
+    self._index_filename = os.path.join(root_dir, INDEX_FILENAME)
+    #имя -> sha256
+    self.names = {}
+    #абсолютный путь исходного файла -> [размер, mtime_ns, sha256], чтобы не читать повторно неизмененные файлы
+    self._sources = {}
+    self._modified = False
+    if os.path.lexists(self._index_filename):
+      with open(self._index_filename, 'r', encoding = 'UTF8') as f:
+        d = json.load(f)
+      self.names = d.get('names', {})
+      self._sources = d.get('sources', {})
+  def _digest(self, filename):
+    st = os.stat(filename)
+    key = os.path.abspath(filename)
+    t = self._sources.get(key)
+    if (t is None) or (t[0] != st.st_size) or (t[1] != st.st_mtime_ns):
+      t = [st.st_size, st.st_mtime_ns, io_utils.file_digest(filename)]
+      self._sources[key] = t
+      self._modified = True
+    return t[2]
+  def object_filename(self, digest):
+    return os.path.join(self._objects_dir, digest[:2], digest + '.pdf')
+  def _store(self, filename, digest):
+    obj = self.object_filename(digest)
+    if os.path.lexists(obj):
+      return obj
+    os.makedirs(os.path.dirname(obj), exist_ok = True)
+    tmp = obj + '.tmp'
+    shutil.copy2(filename, tmp)
+    os.replace(tmp, obj)
+    return obj
+  def _link(self, obj, link_filename):
+    if os.path.lexists(link_filename):
+      os.unlink(link_filename)
+    try:
+      os.link(obj, link_filename)
+      return
+    except OSError as err:
+      logging.debug(f'Can not create hardlink "{link_filename}": {err}')
+    try:
+      os.symlink(os.path.relpath(obj, os.path.dirname(link_filename)), link_filename)
+      return
+    except OSError as err:
+      logging.debug(f'Can not create symlink "{link_filename}": {err}')
+    shutil.copy2(obj, link_filename)
+  def add(self, filename, name):
+    """ returns путь к файлу с именем name в архиве """
+    link_filename = os.path.join(self.root_dir, name)
+    digest = self._digest(filename)
+    if (self.names.get(name) == digest) and os.path.lexists(link_filename):
+      logging.debug(f'"{filename}" is already archived as "{name}"')
+      return link_filename
+    obj = self._store(filename, digest)
+    self._link(obj, link_filename)
+    self.names[name] = digest
+    self._modified = True
+    logging.info(f'"{filename}" is archived as "{name}"')
+    return link_filename
+  def save(self):
+    if not self._modified:
+      return
+    tmp = self._index_filename + '.tmp'
+    with open(tmp, 'w', encoding = 'UTF8') as f:
+      json.dump({ 'names': self.names, 'sources': self._sources }, f, ensure_ascii = False)
+    os.replace(tmp, self._index_filename)
+    self._modified = False
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod(verbose=True)
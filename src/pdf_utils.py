@@ -1,30 +1,334 @@
 # -*- coding: UTF8 -*-
 
+from concurrent.futures import ThreadPoolExecutor
+import json
 import logging
 import os
+import re
+import shutil
 import subprocess
 import tempfile
+import threading
 import uuid
 
-def pdf_to_tsv(input_filename, output_filename):
+try:
+  import resource
+except ImportError:
+  #Windows: ограничения памяти и процессорного времени не поддерживаются
+  resource = None
+
+import io_utils
+
+#ограничения одного запуска pdftotext
+TIMEOUT = 120.0
+MEMORY_LIMIT = 2 << 30
+#процессорное время не больше таймаута, иначе ограничение никогда не срабатывает раньше него
+CPU_LIMIT = 100
+#повторные запуски после таймаута или аварийного завершения
+RETRIES = 1
+#после стольких неудачных конвертаций файл помещается в карантин
+MAX_FAILURES = 2
+FAILURES_FILENAME = '.failures.json'
+
+def _crop_options(region):
+  """
+  опции pdftotext для извлечения только прямоугольной области страницы,
+  координаты в пунктах (как left/top в tsv), поэтому разрешение фиксируется 72 dpi
+  >>> _crop_options({'page': 2, 'x': 10.4, 'y': 20, 'W': 300, 'H': 400})
+  ['-f', '2', '-l', '2', '-r', '72', '-x', '10', '-y', '20', '-W', '300', '-H', '400']
+  """
+  a = []
+  page = region.get('page')
+  if not page is None:
+    a.extend(['-f', str(page), '-l', str(page)])
+  a.extend(['-r', '72'])
+  for key in ['x', 'y', 'W', 'H']:
+    a.extend([f'-{key}', str(int(region[key]))])
+  return a
+
+def percentile(values, q):
+  """
+  процентиль методом ближайшего ранга
+  >>> percentile([5, 1, 4, 2, 3], 50), percentile([5, 1, 4, 2, 3], 99), percentile([], 50)
+  (3, 5, None)
+  """
+  if len(values) == 0:
+    return None
+  a = sorted(values)
+  return a[max(0, -(-len(a) * q // 100) - 1)]
+
+def _rlimits(memory_limit, cpu_limit):
+  """
+  ограничения адресного пространства и процессорного времени, которые устанавливаются уже запущенному
+  дочернему процессу через prlimit (есть только в Linux), preexec_fn не используется:
+  код между fork и exec в многопоточной программе может зависнуть на блокировке другого потока
+  """
+  if (resource is None) or (not hasattr(resource, 'prlimit')):
+    return []
+  a = []
+  if not memory_limit is None:
+    a.append((resource.RLIMIT_AS, memory_limit))
+  if not cpu_limit is None:
+    a.append((resource.RLIMIT_CPU, cpu_limit))
+  return a
+
+class Converter:
+  """
+  запуск pdftotext и pdfinfo под надзором: таймаут, ограничения памяти и процессорного времени (RLIMIT, только Linux),
+  ограниченное количество повторов после таймаута или аварийного завершения,
+  файлы (по sha256 содержимого), которые не удалось сконвертировать max_failures раз,
+  копируются в quarantine_dir и больше не конвертируются,
+  stats() возвращает количество запусков, количество сконвертированных входных файлов (converted)
+  и процентили длительности конвертации одного файла: ее сообщает вызывающий код через converted(),
+  потому что файл может конвертироваться несколькими запусками (диапазоны страниц, область и затем весь файл)
+  """
+  def __init__(self, timeout = TIMEOUT, memory_limit = MEMORY_LIMIT, cpu_limit = CPU_LIMIT, retries = RETRIES,
+               quarantine_dir = None, max_failures = MAX_FAILURES):
+    self.timeout = timeout
+    self.retries = retries
+    self.quarantine_dir = quarantine_dir
+    self.max_failures = max_failures
+    self._rlimits = _rlimits(memory_limit, None if cpu_limit is None else min(cpu_limit, max(1, int(timeout))))
+    self._lock = threading.Lock()
+    self._latencies = []
+    self._stats = { 'runs': 0, 'failed': 0, 'timeouts': 0, 'retries': 0, 'quarantined': 0, 'skipped': 0 }
+    #путь -> ((размер, mtime), sha256)
+    self._digests = {}
+    #sha256 -> количество неудачных конвертаций
+    self._failures = self._load_failures()
+  def _failures_filename(self):
+    return os.path.join(self.quarantine_dir, FAILURES_FILENAME)
+  def _load_failures(self):
+    if (self.quarantine_dir is None) or (not os.path.lexists(self._failures_filename())):
+      return {}
+    try:
+      with open(self._failures_filename(), 'r', encoding = 'UTF8') as f:
+        return json.load(f)
+    except (OSError, ValueError) as err:
+      logging.warning(f'Ignore broken failures file "{self._failures_filename()}": {err}')
+      return {}
+  def _save_failures(self):
+    io_utils.create_dir_if_absent(self.quarantine_dir)
+    tmp = self._failures_filename() + '.tmp'
+    with open(tmp, 'w', encoding = 'UTF8') as f:
+      json.dump(self._failures, f)
+    os.replace(tmp, self._failures_filename())
+  def _digest(self, filename):
+    st = os.stat(filename)
+    key = (st.st_size, st.st_mtime_ns)
+    with self._lock:
+      t = self._digests.get(filename)
+    if (t is None) or (t[0] != key):
+      t = (key, io_utils.file_digest(filename))
+      with self._lock:
+        self._digests[filename] = t
+    return t[1]
+  def is_quarantined(self, input_filename):
+    if self.quarantine_dir is None:
+      return False
+    digest = self._digest(input_filename)
+    with self._lock:
+      return self._failures.get(digest, 0) >= self.max_failures
+  def failed(self, input_filename):
+    """
+    вызывается один раз на конвертацию файла, даже если она состояла из нескольких запусков
+    (диапазоны страниц), иначе многостраничный файл попадал бы в карантин после первой же попытки
+    """
+    with self._lock:
+      self._stats['failed'] += 1
+    if self.quarantine_dir is None:
+      return
+    digest = self._digest(input_filename)
+    with self._lock:
+      n = self._failures.get(digest, 0) + 1
+      self._failures[digest] = n
+      self._save_failures()
+      if n != self.max_failures:
+        return
+      self._stats['quarantined'] += 1
+    logging.error(f'"{input_filename}" failed to convert {n} times and is quarantined in "{self.quarantine_dir}"')
+    shutil.copy2(input_filename, os.path.join(self.quarantine_dir, f'{digest}.pdf'))
+  def _set_limits(self, pid):
+    for limit, value in self._rlimits:
+      try:
+        resource.prlimit(pid, limit, (value, value))
+      except ProcessLookupError:
+        #процесс уже завершился
+        return
+  def _execute(self, command, capture_output):
+    p = subprocess.Popen(command, shell = False, stdout = subprocess.PIPE if capture_output else None)
+    try:
+      self._set_limits(p.pid)
+      out, _ = p.communicate(timeout = self.timeout)
+      return (p.returncode, out)
+    except BaseException:
+      p.kill()
+      #потомки убитого процесса могут держать канал stdout открытым, поэтому не дочитываем его
+      if not p.stdout is None:
+        p.stdout.close()
+      p.wait()
+      raise
+  def _supervise(self, command, input_filename, capture_output = False):
+    """ returns (код завершения, stdout или None), код -2 при таймауте, -3 для файлов в карантине """
+    if self.is_quarantined(input_filename):
+      logging.warning(f'Skip quarantined file "{input_filename}"')
+      with self._lock:
+        self._stats['skipped'] += 1
+      return (-3, None)
+    out = None
+    for attempt in range(self.retries + 1):
+      if attempt > 0:
+        logging.warning(f'Retry #{attempt} of {command}')
+        with self._lock:
+          self._stats['retries'] += 1
+      with self._lock:
+        self._stats['runs'] += 1
+      try:
+        returncode, out = self._execute(command, capture_output)
+      except subprocess.TimeoutExpired:
+        logging.warning(f'{command[0]} is killed after {self.timeout}s timeout')
+        with self._lock:
+          self._stats['timeouts'] += 1
+        returncode = -2
+      #положительный код - ошибка в файле, повтор не поможет,
+      #отрицательный - процесс убит сигналом (превышены ограничения) или таймаутом
+      if returncode >= 0:
+        break
+    return (returncode, out)
+  def run(self, command, input_filename):
+    """ returns код завершения pdftotext, -2 при таймауте, -3 для файлов в карантине """
+    returncode, _ = self._supervise(command, input_filename)
+    return returncode
+  def converted(self, seconds):
+    """ входной файл сконвертирован за seconds (все запуски pdftotext для него) """
+    with self._lock:
+      self._latencies.append(seconds)
+  def output(self, command, input_filename):
+    """ запуск вспомогательной утилиты (pdfinfo) под тем же надзором, returns (код завершения, stdout) """
+    return self._supervise(command, input_filename, capture_output = True)
+  def stats(self):
+    with self._lock:
+      d = dict(self._stats)
+      latencies = list(self._latencies)
+    d['converted'] = len(latencies)
+    for q in [50, 90, 99]:
+      v = percentile(latencies, q)
+      d[f'p{q}_ms'] = None if v is None else v * 1e3
+    d['max_ms'] = max(latencies) * 1e3 if len(latencies) > 0 else None
+    return d
+
+#используется pdf_to_tsv, вызывающий код может заменить его на Converter с папкой карантина
+CONVERTER = Converter()
+
+def pdf_to_tsv(input_filename, output_filename, first_page = None, last_page = None, crop = None):
   if not os.path.lexists(input_filename):
     logging.error(f'File "{input_filename}" not found.')
     return -1
-  command = ['pdftotext', '-tsv', input_filename, output_filename]
+  command = ['pdftotext', '-tsv']
+  if not crop is None:
+    command.extend(_crop_options(crop))
+  if not first_page is None:
+    command.extend(['-f', str(first_page)])
+  if not last_page is None:
+    command.extend(['-l', str(last_page)])
+  command.extend([input_filename, output_filename])
   logging.info(f'Running command {command}')
-  r = subprocess.run(command, check = False, shell = False)
-  if r.returncode != 0:
-    logging.warning('pdftotext returns %s errorcode', r.returncode)
+  returncode = CONVERTER.run(command, input_filename)
+  if returncode != 0:
+    logging.warning('pdftotext returns %s errorcode', returncode)
   else:
     logging.debug('pdftotext succesfully terminated')
-  return r.returncode
+  return returncode
+
+def _parse_pdfinfo_pages(output):
+  """
+  >>> _parse_pdfinfo_pages('Producer:  x\\nPages:          12\\nEncrypted:  no\\n')
+  12
+  >>> _parse_pdfinfo_pages('Producer:  x\\n') is None
+  True
+  """
+  m = re.search(r'^Pages:\s+(\d+)\s*$', output, re.MULTILINE)
+  if m is None:
+    return None
+  return int(m.group(1))
+
+def pdf_page_count(input_filename):
+  """
+  количество страниц в pdf файле (утилита pdfinfo из того же пакета poppler),
+  returns (код завершения pdfinfo, количество страниц или None, если pdfinfo не установлен)
+  """
+  command = ['pdfinfo', input_filename]
+  logging.debug(f'Running command {command}')
+  try:
+    returncode, out = CONVERTER.output(command, input_filename)
+  except FileNotFoundError as err:
+    logging.warning(f"Can't run pdfinfo. {err}")
+    return (0, None)
+  if returncode != 0:
+    logging.warning('pdfinfo returns %s errorcode', returncode)
+    return (returncode, None)
+  return (0, _parse_pdfinfo_pages(out.decode('UTF8', errors = 'replace')))
+
+def split_pages(pages, pages_per_job):
+  """
+  >>> split_pages(5, 2)
+  [(1, 2), (3, 4), (5, 5)]
+  >>> split_pages(1, 4)
+  [(1, 1)]
+  """
+  return [(f, min(f + pages_per_job - 1, pages)) for f in range(1, pages + 1, pages_per_job)]
 
-def pdt_to_temporary_tsv(input_filename):
+def _temporary_tsv_filename(input_filename, suffix = ''):
   bn = os.path.basename(input_filename)
   temp_dir = tempfile.gettempdir()
-  unique_name = f".{bn}-{uuid.uuid4().hex}.tsv"
-  temp_file_path = os.path.join(temp_dir, unique_name)
-  r = pdf_to_tsv(input_filename, temp_file_path)
+  unique_name = f".{bn}-{uuid.uuid4().hex}{suffix}.tsv"
+  return os.path.join(temp_dir, unique_name)
+
+def _conversion_failed(returncode):
+  """
+  ошибка pdftotext, таймаут или превышение ограничений, но не отсутствие файла (-1) и не карантин (-3)
+  >>> list(map(_conversion_failed, [0, 1, -1, -2, -3, -9]))
+  [False, True, False, True, False, True]
+  """
+  return not returncode in (0, -1, -3)
+
+def pdt_to_temporary_tsv(input_filename, crop = None):
+  temp_file_path = _temporary_tsv_filename(input_filename)
+  r = pdf_to_tsv(input_filename, temp_file_path, crop = crop)
   if r == 0:
     return temp_file_path
+  if _conversion_failed(r):
+    CONVERTER.failed(input_filename)
   return None
+
+def pdt_to_temporary_tsv_pages(input_filename, pages_per_job = None, jobs = None):
+  """
+  постраничная конвертация: диапазоны по pages_per_job страниц конвертируются параллельно запусками pdftotext -f/-l,
+  без pages_per_job файл конвертируется одним запуском (и pdfinfo не вызывается),
+  возвращает список временных tsv файлов в порядке страниц или None
+  """
+  if pages_per_job is None:
+    o = pdt_to_temporary_tsv(input_filename)
+    return None if o is None else [o]
+  returncode, pages = pdf_page_count(input_filename)
+  if returncode != 0:
+    #pdf, который не открывает pdfinfo, не сконвертирует и pdftotext
+    if _conversion_failed(returncode):
+      CONVERTER.failed(input_filename)
+    return None
+  if (pages is None) or (pages <= pages_per_job):
+    o = pdt_to_temporary_tsv(input_filename)
+    return None if o is None else [o]
+  ranges = split_pages(pages, pages_per_job)
+  filenames = [_temporary_tsv_filename(input_filename, f'-{f}-{l}') for f, l in ranges]
+  logging.debug(f'Converting {pages} pages of "{input_filename}" in {len(ranges)} ranges')
+  with ThreadPoolExecutor(max_workers = jobs) as executor:
+    codes = list(executor.map(lambda t: pdf_to_tsv(input_filename, t[1], t[0][0], t[0][1]), zip(ranges, filenames)))
+  if any(map(lambda c: c != 0, codes)):
+    if any(map(_conversion_failed, codes)):
+      CONVERTER.failed(input_filename)
+    for fn in filenames:
+      if os.path.lexists(fn):
+        os.unlink(fn)
+    return None
+  return filenames
@@ -0,0 +1,129 @@
+# -*- coding: UTF8 -*-
+"""
+измерение производительности: длительности вызовов, счетчики и задержка цикла событий tk,
+результат сохраняется в формате chrome trace (chrome://tracing, https://ui.perfetto.dev)
+включается переменной окружения PERF_TRACE=имя_файла.json
+"""
+
+import collections
+import contextlib
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+#в трассе остаются только последние события (пульс цикла событий добавляет 10 событий в секунду),
+#итоги summary() учитывают все вызовы
+MAX_EVENTS = 200000
+
+class Profiler:
+  """
+  без файла трассы замеры не выполняются, в трассе остаются последние max_events событий
+  >>> Profiler().timed()(abs)(-1), Profiler().summary()
+  (1, {})
+  >>> p = Profiler('trace.json', max_events = 2)
+  >>> for _ in range(3):
+  ...   with p.span('parse'):
+  ...     pass
+  >>> p.counter('queue', 5)
+  >>> p.summary()['parse']['calls'], [e['ph'] for e in p._events], p.last['queue']
+  (3, ['X', 'C'], 5)
+  """
+  def __init__(self, trace_filename = None, max_events = MAX_EVENTS):
+    self.trace_filename = trace_filename
+    self._events = collections.deque(maxlen = max_events)
+    #имя -> (количество вызовов, суммарное время в секундах, максимальное время)
+    self._totals = {}
+    self._lock = threading.Lock()
+    self._t0 = time.perf_counter()
+    self.last = {}
+  def enabled(self):
+    return not self.trace_filename is None
+  def _ts(self, t):
+    return (t - self._t0) * 1e6
+  def _add(self, name, start, duration):
+    with self._lock:
+      self._events.append({ 'name': name, 'ph': 'X', 'ts': self._ts(start), 'dur': duration * 1e6,
+                            'pid': os.getpid(), 'tid': threading.get_ident() })
+      n, tot, mx = self._totals.get(name, (0, 0.0, 0.0))
+      self._totals[name] = (n + 1, tot + duration, max(mx, duration))
+      self.last[name] = duration
+  @contextlib.contextmanager
+  def span(self, name):
+    if not self.enabled():
+      yield
+      return
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self._add(name, start, time.perf_counter() - start)
+  def timed(self, name = None):
+    """ декоратор, замеряющий время выполнения функции """
+    def decorator(f):
+      n = f.__qualname__ if name is None else name
+      @functools.wraps(f)
+      def wrapper(*args, **kwargs):
+        if not self.enabled():
+          return f(*args, **kwargs)
+        with self.span(n):
+          return f(*args, **kwargs)
+      return wrapper
+    return decorator
+  def counter(self, name, value):
+    if not self.enabled():
+      return
+    with self._lock:
+      self._events.append({ 'name': name, 'ph': 'C', 'ts': self._ts(time.perf_counter()),
+                            'pid': os.getpid(), 'args': { name: value } })
+      self.last[name] = value
+  def start_heartbeat(self, root, interval_ms = 100):
+    """ задержка цикла событий: насколько позже ожидаемого вызывается root.after """
+    if not self.enabled():
+      return
+    def beat(expected):
+      now = time.perf_counter()
+      self.counter('event_loop_latency_ms', max(0.0, (now - expected) * 1e3))
+      root.after(interval_ms, beat, now + interval_ms / 1e3)
+    root.after(interval_ms, beat, time.perf_counter() + interval_ms / 1e3)
+  def summary(self):
+    with self._lock:
+      return { name: { 'calls': n, 'total_ms': tot * 1e3, 'max_ms': mx * 1e3 } for name, (n, tot, mx) in self._totals.items() }
+  def save(self):
+    if not self.enabled():
+      return
+    for name, d in sorted(self.summary().items()):
+      logging.info(f'perf {name}: {d}')
+    with self._lock:
+      events = list(self._events)
+    with open(self.trace_filename, 'w', encoding = 'UTF8') as f:
+      json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms' }, f)
+    logging.info(f'Performance trace is saved to "{self.trace_filename}"')
+
+def peak_rss():
+  """
+  пиковый размер резидентной памяти в байтах: (этот процесс, дочерние процессы, например pdftotext)
+  или None, если модуль resource недоступен (Windows)
+  """
+  if resource is None:
+    return None
+  #в macOS ru_maxrss в байтах, в Linux - в килобайтах
+  k = 1 if sys.platform == 'darwin' else 1024
+  return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * k, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * k)
+
+PROFILER = Profiler(os.getenv('PERF_TRACE'))
+
+def timed(name = None):
+  return PROFILER.timed(name)
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod(verbose=True)
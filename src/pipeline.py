@@ -0,0 +1,232 @@
+# -*- coding: UTF8 -*-
+"""
+однократная конвертация и разбор pdf квитанции с передачей результата нескольким приемникам:
+месячным файлам хранилищ (StorageSink) и набору данных экспорта (DatasetSink)
+
+приемник реализует:
+  crop_region(filename) - область страницы, которой достаточно для разбора, или None
+  parse(filename, rl, cropped) - результат разбора или None (квитанция не подходит)
+  complete(filename, result) - достаточно ли для результата линий из области страницы,
+                               если хотя бы одному приемнику недостаточно, pdf конвертируется
+                               целиком и разбирается заново всеми приемниками
+  commit(filename, result) - сохранение результата, returns значение для вызывающего
+"""
+
+import contextlib
+import logging
+import os
+import threading
+import time
+
+import pdf_utils
+import storage
+import tsv
+
+def _convert(filename, crop = None, jobs = None, pages_per_job = None):
+  """ временные tsv файлы или None """
+  if crop is None:
+    return pdf_utils.pdt_to_temporary_tsv_pages(filename, pages_per_job, jobs)
+  o = pdf_utils.pdt_to_temporary_tsv(filename, crop = crop)
+  return None if o is None else [o]
+
+def _read(tsv_filenames, jobs = None):
+  try:
+    return tsv.read_receipt_lines(tsv_filenames, jobs)
+  finally:
+    for fn in tsv_filenames:
+      os.unlink(fn)
+
+def _found_rows(s, rl):
+  return { i for i, n in enumerate(rl.numbers_by_row(s.schema)) if not n is None }
+
+class StorageSink:
+  """ сохраняет квитанцию в хранилище, схема которого лучше всего подходит """
+  def __init__(self, storages: list[storage.Storage], locks = None):
+    self.storages = storages
+    #id(storage) -> threading.Lock, чтобы потоки не писали в одно хранилище одновременно
+    self._locks = { id(s): threading.Lock() for s in storages } if locks is None else locks
+    #id(storage) -> номера строк схемы, найденных при последнем полном разборе
+    self._full_rows = {}
+  def crop_region(self, filename):
+    return None
+  def route(self, rl) -> storage.Storage:
+    best = max(self.storages, key = lambda s: s.matched_rows(rl), default = None)
+    if (best is None) or (best.matched_rows(rl) == 0):
+      return None
+    return best
+  def parse(self, filename, rl, cropped):
+    if rl.first_date is None:
+      logging.error(f'Date was not found in PDF file "{filename}"')
+      return None
+    s = self.route(rl)
+    if s is None:
+      logging.error(f'No storage schema matches "{filename}"')
+      return None
+    if not cropped:
+      self._full_rows[id(s)] = _found_rows(s, rl)
+    return (s, rl)
+  def complete(self, filename, result):
+    """
+    в области страницы должны найтись все строки схемы хранилища, найденные при последнем полном разборе,
+    пока хранилище не встречалось в полном разборе, области недостаточно,
+    квитанция, которая не подходит ни одному хранилищу, этому приемнику не нужна
+    """
+    if result is None:
+      return True
+    s, rl = result
+    required = self._full_rows.get(id(s))
+    return (not required is None) and required.issubset(_found_rows(s, rl))
+  def commit(self, filename, result):
+    """ returns (хранилище, флаги storage.FLAG_NEW_YEAR и FLAG_NEW_MONTH) """
+    s, rl = result
+    year, month = rl.first_date
+    with self._locks[id(s)]:
+      flags = s.save_csv(year, month, rl)
+    logging.info(f'"{filename}" saved to "{s.schema.title()}" as {rl.first_strdate()}')
+    return (s, flags)
+
+class DatasetSink:
+  """
+  записи (date, id, row, col, value) для набора данных экспорта по json конфигурациям,
+  тип квитанции берется из начала имени файла или подбирается перебором конфигураций,
+  найденная область таблицы запоминается рядом с конфигурацией для следующих запусков
+  """
+  def __init__(self, json_configuration_filenames: list[str]):
+    self.configurations = []
+    self._filenames = {}
+    self.templates = {}
+    for fn in json_configuration_filenames:
+      j = tsv.load_json_configuration(fn)
+      self.configurations.append(j)
+      self._filenames[j['id']] = fn
+      #шаблоны расположения строк по предыдущим запускам
+      self.templates[j['id']] = tsv.LayoutTemplate.load(tsv.layout_template_filename(fn))
+    self.series = []
+    self._lock = threading.Lock()
+  def _expected(self, filename):
+    k = [j for j in self.configurations if os.path.basename(filename).startswith(j['id'])]
+    return k[0] if len(k) == 1 else None
+  def crop_region(self, filename):
+    j = self._expected(filename)
+    if j is None:
+      return None
+    return tsv.configuration_region(j, self._filenames[j['id']])
+  def parse(self, filename, rl, cropped):
+    """ returns (конфигурация, записи, область таблицы, линии квитанции) """
+    j = self._expected(filename)
+    with self._lock:
+      for c in self.configurations if j is None else [j]:
+        #область и шаблон расположения запоминаются только по полной конвертации
+        region = None if cropped else {}
+        template = None if cropped else self.templates[c['id']]
+        s = tsv.parse_receipt_lines(rl, c, filename, region = region, template = template)
+        if len(s) > 0:
+          return (c, s, region, rl)
+    return None
+  def complete(self, filename, result):
+    if result is None:
+      return False
+    c, s, _region, rl = result
+    return tsv.crop_complete(rl, s, c, self.crop_region(filename))
+  def commit(self, filename, result):
+    """ returns (конфигурация, записи) """
+    c, s, region, _rl = result
+    with self._lock:
+      self.series.extend(s)
+      if (not region is None) and (len(region) > 0) and (not 'region' in c):
+        tsv.save_learned_region(self._filenames[c['id']], region)
+    return (c, s)
+  def save_templates(self):
+    for i, t in self.templates.items():
+      t.save(tsv.layout_template_filename(self._filenames[i]))
+
+class Pipeline:
+  """
+  конвертирует и разбирает каждый pdf один раз и передает линии квитанции всем приемникам,
+  в timings накапливается время этапов: convert (pdftotext), read (tsv), parse и commit,
+  с pages_per_job многостраничные pdf конвертируются параллельно по диапазонам страниц
+  >>> class Sink:
+  ...   def __init__(self, region, enough = True, matches = True):
+  ...     self.region, self.enough, self.matches = region, enough, matches
+  ...   def crop_region(self, filename):
+  ...     return self.region
+  ...   def parse(self, filename, rl, cropped):
+  ...     return rl if self.matches else None
+  ...   def complete(self, filename, result):
+  ...     return self.enough
+  ...   def commit(self, filename, result):
+  ...     return result
+  >>> class OfflinePipeline(Pipeline):
+  ...   def _receipt_lines(self, filename, crop):
+  ...     return ('crop' if crop else 'full', 0.0)
+  >>> OfflinePipeline([Sink({ 'x': 0 }), Sink(None)]).process('r.pdf')
+  ['crop', 'crop']
+  >>> OfflinePipeline([Sink({ 'x': 0 }), Sink(None, enough = False)]).process('r.pdf')
+  ['full', 'full']
+  >>> OfflinePipeline([Sink(None, matches = False)]).process('r.pdf')
+  [None]
+  """
+  STAGES = ['convert', 'read', 'parse', 'commit']
+  def __init__(self, sinks, jobs = None, pages_per_job = None):
+    self.sinks = sinks
+    self.jobs = jobs
+    self.pages_per_job = pages_per_job
+    self.timings = dict.fromkeys(Pipeline.STAGES, 0.0)
+    self._lock = threading.Lock()
+  @contextlib.contextmanager
+  def _stage(self, name):
+    t = time.perf_counter()
+    try:
+      yield
+    finally:
+      with self._lock:
+        self.timings[name] += time.perf_counter() - t
+  def _receipt_lines(self, filename, crop):
+    """ returns (линии квитанции или None, время конвертации) """
+    t = time.perf_counter()
+    with self._stage('convert'):
+      o = _convert(filename, crop, self.jobs, self.pages_per_job)
+    seconds = time.perf_counter() - t
+    if o is None:
+      return (None, seconds)
+    with self._stage('read'):
+      return (_read(o, self.jobs), seconds)
+  def _parse(self, filename, rl, cropped):
+    with self._stage('parse'):
+      return [sink.parse(filename, rl, cropped) for sink in self.sinks]
+  def _complete(self, filename, results):
+    with self._stage('parse'):
+      return all(sink.complete(filename, r) for sink, r in zip(self.sinks, results))
+  def process(self, filename):
+    """
+    returns список результатов commit по приемникам (None для приемников, которым квитанция не подошла)
+    или None, если pdf не удалось сконвертировать
+    """
+    results = None
+    #время всех конвертаций файла, в статистике pdf_utils.CONVERTER одна запись на файл
+    converting = 0.0
+    #если приемник знает область таблицы, то вначале конвертируется только она,
+    #и ее линии получают все приемники, но только когда каждому из них их достаточно
+    crop = next(filter(lambda r: not r is None, (sink.crop_region(filename) for sink in self.sinks)), None)
+    if not crop is None:
+      rl, seconds = self._receipt_lines(filename, crop)
+      converting += seconds
+      if not rl is None:
+        results = self._parse(filename, rl, True)
+        if not self._complete(filename, results):
+          logging.info("Region doesn't contain the whole receipt '%s', converting all pages", filename)
+          results = None
+    if results is None:
+      rl, seconds = self._receipt_lines(filename, None)
+      converting += seconds
+      if rl is None:
+        logging.error("Could not convert '%s' to TSV", filename)
+        return None
+      results = self._parse(filename, rl, False)
+    pdf_utils.CONVERTER.converted(converting)
+    with self._stage('commit'):
+      return [None if r is None else sink.commit(filename, r) for sink, r in zip(self.sinks, results)]
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod(verbose=True)
@@ -0,0 +1,235 @@
+# -*- coding: UTF8 -*-
+"""
+локальный http сервис только для чтения данных хранилищ в формате json
+
+GET /storages                                   список хранилищ
+GET /storages/<i>/years/<year>                  данные года
+GET /storages/<i>/range?from=YYYY-MM&to=YYYY-MM[&row=...][&col=...]
+                                                значения за период, отфильтрованные по строкам и столбцам
+GET /storages/<i>/rollups                       годовые итоги (сумма, минимум, максимум, количество, последнее)
+ответы кешируются (не больше MAX_RESPONSES) и снабжаются ETag, зависящим от времени изменения месячных файлов,
+сервис ничего не пишет в папки данных
+"""
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import json
+import logging
+import math
+import re
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+import storage
+
+MAX_RESPONSES = 256
+
+def _parse_month(s):
+  """
+  >>> _parse_month('2024-07')
+  (2024, 7)
+  >>> _parse_month('2024-13') is None
+  True
+  """
+  m = re.fullmatch(r'(\d{4})-(\d\d)', s)
+  if m is None:
+    return None
+  year, month = int(m.group(1)), int(m.group(2))
+  if not 1 <= month <= 12:
+    return None
+  return (year, month)
+
+def _number(x):
+  return None if math.isnan(x) else float(x)
+
+class StorageIndex:
+  """ индекс в памяти поверх storage.load_storages, перестраивается при изменении файлов хранилища """
+  def __init__(self, storages: list[storage.Storage], max_responses = MAX_RESPONSES):
+    self.storages = storages
+    self.max_responses = max_responses
+    self._locks = [threading.Lock() for _ in storages]
+    self._versions = [None] * len(storages)
+    #(номер хранилища, путь запроса) -> (версия файлов хранилища, тело ответа), в порядке последнего использования
+    self._responses = OrderedDict()
+    self._responses_lock = threading.Lock()
+  def _refresh(self, i):
+    """ returns текущую версию файлов хранилища, вызывается под блокировкой хранилища """
+    s = self.storages[i]
+    v = s.files_version()
+    if v != self._versions[i]:
+      if not self._versions[i] is None:
+        logging.info(f'Storage "{s.schema.title()}" was modified, reloading')
+      s.invalidate()
+      self._versions[i] = v
+    return v
+  def version(self):
+    h = hashlib.sha1()
+    for i in range(len(self.storages)):
+      with self._locks[i]:
+        h.update(self._refresh(i).encode('UTF8'))
+    return h.hexdigest()
+  def list_storages(self):
+    a = []
+    for i, s in enumerate(self.storages):
+      with self._locks[i]:
+        self._refresh(i)
+        a.append({ 'index': i, 'title': s.schema.title(), 'columns': s.schema.columns_names(),
+                   'rows': [{ 'name': r[0], 'units': r[1] } for r in s.schema.rows],
+                   'years': s.available_years() })
+    return a
+  def year(self, i, year):
+    s = self.storages[i]
+    with self._locks[i]:
+      self._refresh(i)
+      m = s.load_year_matrix(year)
+    return { 'year': year, 'months': m.months, 'columns': s.schema.columns_names(),
+             'rows': [{ 'name': r[0], 'units': r[1], 'values': [[_number(x) for x in month] for month in v] }
+                      for r, v in zip(s.schema.rows, m.values)] }
+  def range(self, i, first, last, rows = None, cols = None):
+    s = self.storages[i]
+    names = s.schema.columns_names()
+    col_ids = [j for j, c in enumerate(names) if (cols is None) or (c in cols)]
+    row_ids = [j for j, r in enumerate(s.schema.rows) if (rows is None) or (r[0] in rows)]
+    a = []
+    with self._locks[i]:
+      self._refresh(i)
+      for year in s.available_years():
+        if not first[0] <= year <= last[0]:
+          continue
+        m = s.load_year_matrix(year)
+        for k, month in enumerate(m.months):
+          if not first <= (year, month) <= last:
+            continue
+          for r in row_ids:
+            for c in col_ids:
+              a.append({ 'month': f'{year}-{month:02d}', 'row': s.schema.rows[r][0], 'col': names[c],
+                         'value': _number(m.values[r, k, c]) })
+    return a
+  def rollups(self, i):
+    s = self.storages[i]
+    with self._locks[i]:
+      self._refresh(i)
+      #итоги не сохраняются, чтобы не писать в папку данных
+      rollups = s.rollups(persist = False)
+    return { 'columns': s.schema.columns_names(),
+             'years': { str(year): { 'months': r.months,
+                                     'rows': [dict({ 'name': row[0] },
+                                                   **{ k: [_number(x) for x in getattr(r, k)[j]] for k in storage.YearRollup.AGGREGATES })
+                                              for j, row in enumerate(s.schema.rows)] }
+                        for year, r in rollups.items() } }
+  def current_version(self, i):
+    """ версия всех хранилищ (i is None) или хранилища i """
+    if i is None:
+      return self.version()
+    with self._locks[i]:
+      return self._refresh(i)
+  @staticmethod
+  def etag(version, key):
+    return '"' + hashlib.sha1(f'{version}:{key}'.encode('UTF8')).hexdigest() + '"'
+  def response(self, i, key, version, build):
+    """
+    тело ответа из кеша или построенное функцией build,
+    version - версия, полученная до построения (ответ не старее своего ETag),
+    тело кешируется с этой версией и выбрасывается, если хранилище изменилось
+    """
+    if i is None:
+      return json.dumps(build(), ensure_ascii = False).encode('UTF8')
+    k = (i, key)
+    with self._responses_lock:
+      e = self._responses.get(k)
+      if (not e is None) and (e[0] == version):
+        self._responses.move_to_end(k)
+        return e[1]
+    body = json.dumps(build(), ensure_ascii = False).encode('UTF8')
+    #если хранилище изменилось во время построения, то ответ мог собраться из разных версий и не кешируется
+    built_version = self.current_version(i)
+    with self._responses_lock:
+      if built_version == version:
+        self._responses[k] = (version, body)
+        self._responses.move_to_end(k)
+        while len(self._responses) > self.max_responses:
+          self._responses.popitem(last = False)
+      else:
+        self._responses.pop(k, None)
+    return body
+
+class _Handler(BaseHTTPRequestHandler):
+  index = None
+  def log_message(self, format, *args):
+    logging.debug('%s %s', self.address_string(), format % args)
+  def _send(self, code, etag = None, body = b''):
+    self.send_response(code)
+    if not etag is None:
+      self.send_header('ETag', etag)
+      self.send_header('Cache-Control', 'no-cache')
+    if code != 304:
+      self.send_header('Content-Type', 'application/json; charset=utf-8')
+      self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    if code != 304:
+      self.wfile.write(body)
+  def _error(self, code, msg):
+    self._send(code, body = json.dumps({ 'error': msg }, ensure_ascii = False).encode('UTF8'))
+  def do_GET(self):
+    try:
+      self._get()
+    except Exception:
+      logging.exception(f'Failed request "{self.path}"')
+      self._error(500, 'internal error')
+  def _get(self):
+    u = urlsplit(self.path)
+    parts = [p for p in u.path.split('/') if len(p) > 0]
+    index = self.index
+    if (len(parts) == 0) or (parts[0] != 'storages'):
+      self._error(404, 'not found')
+      return
+    if len(parts) == 1:
+      build = index.list_storages
+      i = None
+    else:
+      try:
+        i = int(parts[1])
+      except ValueError:
+        i = -1
+      if not 0 <= i < len(index.storages):
+        self._error(404, 'unknown storage')
+        return
+      q = parse_qs(u.query)
+      if (len(parts) == 4) and (parts[2] == 'years') and parts[3].isdigit():
+        year = int(parts[3])
+        build = lambda: index.year(i, year)
+      elif (len(parts) == 3) and (parts[2] == 'range'):
+        first = _parse_month(q.get('from', ['0000-01'])[0])
+        last = _parse_month(q.get('to', ['9999-12'])[0])
+        if (first is None) or (last is None):
+          self._error(400, 'month must be in YYYY-MM format')
+          return
+        build = lambda: index.range(i, first, last, q.get('row'), q.get('col'))
+      elif (len(parts) == 3) and (parts[2] == 'rollups'):
+        build = lambda: index.rollups(i)
+      else:
+        self._error(404, 'not found')
+        return
+    key = u.path + '?' + u.query
+    version = index.current_version(i)
+    etag = index.etag(version, key)
+    if self.headers.get('If-None-Match') == etag:
+      self._send(304, etag)
+      return
+    self._send(200, etag, index.response(i, key, version, build))
+
+def serve(storages: list[storage.Storage], host = '127.0.0.1', port = 8000):
+  handler = type('Handler', (_Handler,), { 'index': StorageIndex(storages) })
+  server = ThreadingHTTPServer((host, port), handler)
+  logging.info(f'Serving {len(storages)} storages on http://{host}:{port}/storages')
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod(verbose=True)
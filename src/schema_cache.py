@@ -0,0 +1,230 @@
+# -*- coding: UTF8 -*-
+"""
+компиляция схем обоих форматов с кешированием на диске:
+- json конфигурации из папки conf (id, rows с name и columns_ids, columns) для tsv.parse_receipt_lines
+- json хранилища с csv файлом строк (name units columns) для schema.ExtractionSchema
+схема проверяется один раз, результат (индекс названий, отображения столбцов, варианты названий
+через ' / ' и словарь для поиска по началу названия) сохраняется в __schemacache__ рядом с json
+и используется, пока не изменятся исходные файлы (проверяются mtime, размер, затем sha256)
+"""
+
+import csv
+import json
+import logging
+import os
+import pickle
+
+import io_utils
+
+CACHE_DIR = '__schemacache__'
+#увеличивается при изменении формата CompiledSchema
+COMPILER_VERSION = 1
+
+KIND_CONFIGURATION = 'configuration'
+KIND_EXTRACTION = 'extraction'
+
+class CompiledSchema:
+  """
+  результат компиляции схемы, для конфигураций поддерживает доступ как к исходному словарю (d['rows'])
+  rows - список (name, units, columns), где columns - номера столбцов
+  """
+  def __init__(self, kind, source, rows, columns_names):
+    """
+    в конфигурациях columns - номера столбцов из columns_names,
+    в схемах хранилищ columns - номера чисел линии квитанции для каждого из columns_names (-1 - не извлекается)
+    """
+    self.kind = kind
+    self.source = source
+    self.rows = rows
+    self.columns_names = columns_names
+    self.row_names = [r[0] for r in rows]
+    self.name_index = { name: i for i, name in enumerate(self.row_names) }
+    #варианты названия строки (' / ' разделяет варианты, например содержание газонов или уборка снега)
+    self.alternatives = [tuple(name.split(' / ')) for name in self.row_names]
+    #номер строки -> названия извлекаемых столбцов (None для неизвлекаемых)
+    if kind == KIND_CONFIGURATION:
+      self.column_map = [[columns_names[c] for c in r[2]] for r in rows]
+    else:
+      self.column_map = [[name if c >= 0 else None for c, name in zip(r[2], columns_names)] for r in rows]
+    #первое слово варианта из нескольких слов -> [(вариант, номер строки)],
+    #такой вариант может быть началом линии, только если её первое слово совпадает с его первым словом
+    self._prefixes = {}
+    #варианты из одного слова проверяются всегда
+    self._single_words = []
+    for i, alts in enumerate(self.alternatives):
+      for a in alts:
+        w = _first_word(a)
+        if w == a:
+          self._single_words.append((a, i))
+        else:
+          self._prefixes.setdefault(w, []).append((a, i))
+    self._memo = {}
+  def __getitem__(self, key):
+    return self.source[key]
+  def __contains__(self, key):
+    return key in self.source
+  def get(self, key, default = None):
+    return self.source.get(key, default)
+  def __getstate__(self):
+    d = dict(self.__dict__)
+    d['_memo'] = {}
+    return d
+  def prefix_rows(self, line_name):
+    """
+    номера строк, один из вариантов названия которых является началом line_name
+    >>> c = CompiledSchema(KIND_EXTRACTION, {}, [('ХВС', '', [0]), ('Газоны / Снег', '', [0]), ('Уборка МОП', '', [0])], ['a'])
+    >>> c.prefix_rows('Снегоуборка'), c.prefix_rows('ХВС м3'), c.prefix_rows('Уборка МОП и лестниц'), c.prefix_rows('Уборка')
+    ([1], [0], [2], [])
+    """
+    a = [(a, i) for a, i in self._single_words if line_name.startswith(a)]
+    a.extend((a, i) for a, i in self._prefixes.get(_first_word(line_name), []) if line_name.startswith(a))
+    return sorted(set(i for _, i in a))
+  def memo(self, key, build):
+    """ производные объекты (например индекс n-грамм), вычисляемые один раз в процессе """
+    v = self._memo.get(key)
+    if v is None:
+      v = build()
+      self._memo[key] = v
+    return v
+
+def _first_word(s):
+  """
+  >>> _first_word('Уборка МОП'), _first_word('')
+  ('Уборка', '')
+  """
+  a = s.split(maxsplit = 1)
+  return a[0] if len(a) > 0 else ''
+
+def _compile_configuration(filename):
+  """ returns (CompiledSchema, исходные файлы) или (None, None) """
+  with open(filename, 'r', encoding = 'UTF8') as f:
+    d = json.load(f)
+  columns = d.get('columns')
+  if (not isinstance(columns, list)) or (not isinstance(d.get('rows'), list)):
+    logging.error(f'compile: "rows" and "columns" lists are expected in "{filename}"')
+    return (None, None)
+  rows = []
+  for k, r in enumerate(d['rows']):
+    name = r.get('name')
+    ids = r.get('columns_ids')
+    if (not isinstance(name, str)) or (not isinstance(ids, list)) or \
+       any(map(lambda x: (not isinstance(x, int)) or (not 0 <= x < len(columns)), ids)):
+      logging.error(f'compile: illegal row #{k} in "{filename}"')
+      return (None, None)
+    rows.append((name, '', ids))
+  return (CompiledSchema(KIND_CONFIGURATION, d, rows, columns), [filename])
+
+def _parse_row_columns(s):
+  """
+  >>> _parse_row_columns('0,-1,2'), _parse_row_columns('0,-2')
+  ([0, -1, 2], None)
+  """
+  l = list(map(int, s.split(',')))
+  if any(map(lambda x: -1 > x, l)):
+    return None
+  return l
+
+def _compile_extraction(filename):
+  """ returns (CompiledSchema, исходные файлы) или (None, None) """
+  with open(filename, 'r', encoding = 'UTF8') as json_file:
+    d = json.load(json_file)
+  columns_names = d.get('columns_names', [])
+  csv_filename = io_utils.path_join(os.path.dirname(filename), d["rows_schema_csv_filename"])
+  a = []
+  with open(csv_filename, 'r', newline='', encoding = 'UTF8') as csvfile:
+    reader = csv.reader(csvfile, delimiter=' ', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    header = next(reader)
+    if header != ['name', 'units', 'columns']:
+      logging.error('load: schema header mismatched')
+      return (None, None)
+    for line, t in enumerate(reader):
+      if len(t) != 3:
+        logging.error(f'load: expected exactly 3 fields in a row (file: "{csv_filename}", line {line+2})')
+        return (None, None)
+      try:
+        cols = _parse_row_columns(t[2])
+      except ValueError as err:
+        logging.error(f'load: can not convert columns indices to List[int] (file: "{csv_filename}", line {line+2}, error "{err}")')
+        return (None, None)
+      if (cols is None) or (len(cols) != len(columns_names)):
+        logging.error(f'load: expected {len(columns_names)} columns indices (file: "{csv_filename}", line {line+2})')
+        return (None, None)
+      a.append((t[0], t[1], cols))
+  return (CompiledSchema(KIND_EXTRACTION, d, a, columns_names), [filename, csv_filename])
+
+def _file_stamp(filename):
+  st = os.stat(filename)
+  return { 'filename': filename, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': io_utils.file_digest(filename) }
+
+def _is_fresh(stamps):
+  for s in stamps:
+    try:
+      st = os.stat(s['filename'])
+    except OSError:
+      return False
+    if (st.st_size == s['size']) and (st.st_mtime_ns == s['mtime_ns']):
+      continue
+    if io_utils.file_digest(s['filename']) != s['sha256']:
+      return False
+  return True
+
+def _cache_filename(filename, kind):
+  """
+  >>> _cache_filename(os.path.join('conf', 'schema-receipt.json'), KIND_CONFIGURATION) == os.path.join('conf', CACHE_DIR, 'schema-receipt.json.configuration.pickle')
+  True
+  """
+  return os.path.join(os.path.dirname(filename), CACHE_DIR, f'{os.path.basename(filename)}.{kind}.pickle')
+
+#кеш в памяти процесса: (kind, абсолютный путь) -> (отпечатки файлов, CompiledSchema)
+_loaded = {}
+
+def _load(filename, kind, compiler):
+  key = (kind, os.path.abspath(filename))
+  t = _loaded.get(key)
+  if (not t is None) and _is_fresh(t[0]):
+    return t[1]
+  cache_filename = _cache_filename(filename, kind)
+  if os.path.lexists(cache_filename):
+    try:
+      with open(cache_filename, 'rb') as f:
+        version, stamps, compiled = pickle.load(f)
+      if (version == COMPILER_VERSION) and _is_fresh(stamps):
+        _loaded[key] = (stamps, compiled)
+        return compiled
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError, AttributeError) as err:
+      logging.debug(f'Ignore broken schema cache "{cache_filename}": {err}')
+  logging.debug(f'Compiling {kind} schema "{filename}"')
+  compiled, sources = compiler(filename)
+  if compiled is None:
+    return None
+  stamps = list(map(_file_stamp, sources))
+  _loaded[key] = (stamps, compiled)
+  try:
+    os.makedirs(os.path.dirname(cache_filename), exist_ok = True)
+    tmp = f'{cache_filename}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+      pickle.dump((COMPILER_VERSION, stamps, compiled), f)
+    os.replace(tmp, cache_filename)
+  except OSError as err:
+    logging.debug(f'Can not write schema cache "{cache_filename}": {err}')
+  return compiled
+
+def load_configuration(json_configuration_filename) -> CompiledSchema:
+  """ скомпилированная json конфигурация для tsv.parse_receipt_lines или None """
+  return _load(json_configuration_filename, KIND_CONFIGURATION, _compile_configuration)
+
+def load_extraction(json_filename) -> CompiledSchema:
+  """ скомпилированная схема хранилища (json и csv файл строк) или None """
+  return _load(json_filename, KIND_EXTRACTION, _compile_extraction)
+
+def compile_configuration(configuration_from_json) -> CompiledSchema:
+  """ компиляция уже загруженного словаря конфигурации без кеширования """
+  if isinstance(configuration_from_json, CompiledSchema):
+    return configuration_from_json
+  d = configuration_from_json
+  rows = [(r['name'], '', r['columns_ids']) for r in d['rows']]
+  return CompiledSchema(KIND_CONFIGURATION, d, rows, d['columns'])
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod(verbose=True)
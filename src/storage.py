@@ -1,21 +1,155 @@
 # -*- coding: UTF8 -*-
 """
 работа с набором csv месячных файлов как с единым целом
+запись безопасна при одновременной работе нескольких процессов (gui, ingest-daemon, export):
+месячный файл пишется во временный файл и заменяется атомарно (os.replace),
+блокировка месяца удерживается от замены до обновления общего манифеста папки данных и годовых итогов,
+поэтому они соответствуют содержимому файла (при одновременной записи одного месяца остается последняя),
+по изменению манифеста остальные процессы пересканируют папку и сбрасывают кеш годовых матриц
 """
 
+import contextlib
 import csv
 import glob
+import hashlib
+import json
 import logging
 import os
 import re
 
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+  import msvcrt
+
+import numpy as np
+
 import io_utils
+import perf
 import schema
 import tsv
 
 FLAG_NEW_YEAR = 1
 FLAG_NEW_MONTH = 2
 
+#имена начинаются с точки, поэтому не совпадают с шаблоном месячных файлов
+MANIFEST_FILENAME = '.manifest.json'
+ROLLUPS_FILENAME = '.rollups.json'
+LOCKS_DIR = '.locks'
+
+class FileLock:
+  """ межпроцессная рекомендательная блокировка (fcntl.flock, в Windows - msvcrt.locking первого байта) """
+  def __init__(self, filename):
+    self.filename = filename
+    self._f = None
+  def __enter__(self):
+    self._f = open(self.filename, 'a+b')
+    try:
+      if fcntl is not None:
+        fcntl.flock(self._f.fileno(), fcntl.LOCK_EX)
+      else:
+        self._f.seek(0)
+        msvcrt.locking(self._f.fileno(), msvcrt.LK_LOCK, 1)
+    except OSError:
+      self._f.close()
+      raise
+    return self
+  def __exit__(self, *args):
+    try:
+      if fcntl is not None:
+        fcntl.flock(self._f.fileno(), fcntl.LOCK_UN)
+      else:
+        self._f.seek(0)
+        msvcrt.locking(self._f.fileno(), msvcrt.LK_UNLCK, 1)
+    finally:
+      self._f.close()
+      self._f = None
+
+def _file_stamp(filename):
+  """ (mtime_ns, размер) или None, если файла нет """
+  try:
+    st = os.stat(filename)
+  except OSError:
+    return None
+  return (st.st_mtime_ns, st.st_size)
+
+def _sync_dir(dirname):
+  """ сохранение на диск записи каталога после os.replace (в Windows не требуется) """
+  if fcntl is None:
+    return
+  fd = os.open(dirname, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+class _Batch:
+  """
+  пакетная запись нескольких месяцев: файлы пишутся во временные и сохраняются на диск (fsync),
+  при выходе из контекста выполняются атомарные замены и одна синхронизация каталога,
+  fsync каждого временного файла - нижняя граница надежности: без него после сбоя питания
+  os.replace может оставить на месте месячного файла пустой или обрезанный файл,
+  поэтому на пакет приходится одна синхронизация каталога, но не одна синхронизация вообще
+  """
+  def __init__(self, storage):
+    self.storage = storage
+    #(year, month) -> временный файл
+    self._pending = {}
+    #(year, month) -> массив строки × столбцы для годовых итогов
+    self._values = {}
+    self.flags = 0
+  def add(self, year: int, month: int, rl: tsv.ReceiptLines):
+    csv_filename = self.storage.compute_csv_filename(year, month)
+    tmp = f'{csv_filename}.{os.getpid()}.{id(self)}.tmp'
+    with open(tmp, 'w', newline='', encoding = 'UTF8') as csvfile:
+      rl.export_csv(csvfile, self.storage.schema)
+      csvfile.flush()
+      os.fsync(csvfile.fileno())
+    old = self._pending.get((year, month))
+    if not old is None:
+      os.remove(old)
+    self._pending[(year, month)] = tmp
+    self._values[(year, month)] = self.storage._month_values(tmp)
+  def discard(self):
+    for tmp in self._pending.values():
+      with contextlib.suppress(OSError):
+        os.remove(tmp)
+    self._pending = {}
+  def commit(self):
+    if len(self._pending) == 0:
+      return
+    s = self.storage
+    keys = sorted(self._pending.keys())
+    values = self._values
+    self._values = {}
+    def update(rollups):
+      for (year, month), v in values.items():
+        r = rollups.get(year)
+        if r is None:
+          if v is None:
+            continue
+          r = rollups[year] = YearRollup(*v.shape)
+        #итоги года с замененным (или нечитаемым) месяцем пересчитываются из месячных файлов при чтении
+        if (v is None) or (not r.add_month(month, v)):
+          rollups.pop(year)
+    with contextlib.ExitStack() as stack:
+      #блокировки берутся в порядке месяцев, чтобы два пакета не ждали друг друга,
+      #и удерживаются до обновления манифеста и итогов, иначе итоги другого процесса,
+      #записавшего тот же месяц раньше, могли бы сохраниться поверх итогов последнего файла
+      for year, month in keys:
+        stack.enter_context(FileLock(s._lock_filename(f'{year}-{month:02d}')))
+      for year, month in keys:
+        os.replace(self._pending[(year, month)], s.compute_csv_filename(year, month))
+      _sync_dir(s.dir)
+      self._pending = {}
+      for year, month in keys:
+        self.flags |= s._add_month(year, month)
+        s._year_matrices.pop(year, None)
+        s._year_matrices.pop(year + 1, None)
+      s._update_manifest(keys)
+      s._update_rollups(update)
+
 def _compute_csv_filename(storage_dir, year, month):
   """
   >>> _compute_csv_filename('', 2024, 7)
@@ -23,6 +157,109 @@ def _compute_csv_filename(storage_dir, year, month):
   """
   return os.path.join(storage_dir, f'{year}-{month:02d}.csv')
 
+def cell_value(s: str) -> float:
+  """
+  числовое значение ячейки месячного csv файла:
+  '?' (нет данных в квитанции) и '' (столбец не извлекается) -> NaN, '-' -> 0
+  >>> cell_value('12,5'), cell_value('-'), cell_value('?')
+  (12.5, 0.0, nan)
+  """
+  if (s == '?') or (s == ''):
+    return np.nan
+  if s == '-':
+    return 0.0
+  return float(s.replace(',', '.'))
+
+class YearMatrix:
+  """
+  данные года в виде массивов размера строки × месяцы × столбцы:
+  values - значения, mom - разница с предыдущим загруженным месяцем,
+  yoy - разница с тем же месяцем предыдущего года (NaN, если сравнивать не с чем)
+  >>> m = YearMatrix([1, 2], [['1', '2', '3,5', '-'], ['?', '', '1', '1']], 2)
+  >>> m.values.shape
+  (2, 2, 2)
+  >>> m.mom[0, 1].tolist(), m.mom[1, 1].tolist()
+  ([2.5, -2.0], [nan, nan])
+  """
+  def __init__(self, months: list[int], data: list[list[str]], columns: int):
+    self.months = months
+    #исходные строки ячеек, как в load_year_data
+    self.data = data
+    n = len(months)
+    a = np.array([[cell_value(x) for x in row] for row in data], dtype = np.float64)
+    self.values = a.reshape(len(data), n, columns)
+    self.mom = np.full_like(self.values, np.nan)
+    self.mom[:, 1:, :] = self.values[:, 1:, :] - self.values[:, :-1, :]
+    self.yoy = np.full_like(self.values, np.nan)
+  def set_previous_year(self, prev):
+    idx = [(j, prev.months.index(m)) for j, m in enumerate(self.months) if m in prev.months]
+    if len(idx) == 0:
+      return
+    cur, old = map(list, zip(*idx))
+    self.yoy[:, cur, :] = self.values[:, cur, :] - prev.values[:, old, :]
+
+def _json_array(a):
+  """
+  >>> _json_array(np.array([[1.0, np.nan]]))
+  [[1.0, None]]
+  """
+  return [[None if v != v else v for v in row] for row in a.tolist()]
+
+class YearRollup:
+  """
+  итоги года по строкам и столбцам (массивы строки × столбцы): сумма, минимум, максимум,
+  количество месяцев со значением и последнее значение (last_month - его месяц),
+  новый месяц добавляется к итогам без чтения остальных месячных файлов,
+  а замену уже учтенного месяца вычесть нельзя (минимум, максимум), поэтому add_month returns False
+  >>> r = YearRollup(2, 1)
+  >>> r.add_month(5, np.array([[2.0], [4.0]])), r.add_month(3, np.array([[1.0], [np.nan]]))
+  (True, True)
+  >>> r.months, r.sum.tolist(), r.count.tolist(), r.last.tolist(), r.min.tolist()
+  ([3, 5], [[3.0], [4.0]], [[2], [1]], [[2.0], [4.0]], [[1.0], [4.0]])
+  >>> r.add_month(5, np.array([[7.0], [7.0]]))
+  False
+  """
+  AGGREGATES = ['sum', 'min', 'max', 'count', 'last']
+  def __init__(self, rows: int, columns: int):
+    self.mask = 0
+    self.sum = np.full((rows, columns), np.nan)
+    self.min = np.full((rows, columns), np.nan)
+    self.max = np.full((rows, columns), np.nan)
+    self.count = np.zeros((rows, columns), dtype = np.int64)
+    self.last = np.full((rows, columns), np.nan)
+    self.last_month = np.zeros((rows, columns), dtype = np.int64)
+  @property
+  def months(self):
+    return [month for month in range(1, 13) if (self.mask & (1 << month)) != 0]
+  def add_month(self, month: int, values) -> bool:
+    if (self.mask & (1 << month)) != 0:
+      return False
+    valid = ~np.isnan(values)
+    self.sum = np.where(valid, np.nan_to_num(self.sum) + np.nan_to_num(values), self.sum)
+    #fmin/fmax пропускают NaN
+    self.min = np.fmin(self.min, values)
+    self.max = np.fmax(self.max, values)
+    self.count = self.count + valid
+    newer = valid & (month > self.last_month)
+    self.last = np.where(newer, values, self.last)
+    self.last_month = np.where(newer, month, self.last_month)
+    self.mask |= 1 << month
+    return True
+  def to_json(self):
+    d = { 'mask': self.mask, 'last_month': self.last_month.tolist() }
+    for k in YearRollup.AGGREGATES:
+      d[k] = _json_array(getattr(self, k))
+    return d
+  @staticmethod
+  def from_json(d, rows, columns):
+    r = YearRollup(rows, columns)
+    r.mask = d['mask']
+    for k in YearRollup.AGGREGATES + ['last_month']:
+      setattr(r, k, np.array(d[k], dtype = np.float64).reshape(rows, columns))
+    r.count = r.count.astype(np.int64)
+    r.last_month = r.last_month.astype(np.int64)
+    return r
+
 class Storage:
   def __init__(self, schema_filename):
     self.schema_filename = schema_filename
@@ -36,6 +273,14 @@ class Storage:
       io_utils.create_dir_if_absent(self.dir)
       self._month_masks_by_year = {}
       self._month_columns = self.schema.columns()
+      self._year_matrices = {}
+      self._manifest_filename = os.path.join(self.dir, MANIFEST_FILENAME)
+      #(mtime_ns, размер) манифеста при последнем сканировании
+      self._manifest_stamp = None
+      self._rollups_filename = os.path.join(self.dir, ROLLUPS_FILENAME)
+      #year -> YearRollup и (mtime_ns, размер) прочитанного файла итогов
+      self._rollups = {}
+      self._rollups_stamp = None
   def is_valid(self):
     return not self.schema is None
   def schema_number_of_rows(self):
@@ -53,9 +298,39 @@ class Storage:
         self._month_masks_by_year[year] = old + bit
         res += FLAG_NEW_MONTH
     return res
+  def _lock_filename(self, name):
+    d = os.path.join(self.dir, LOCKS_DIR)
+    os.makedirs(d, exist_ok = True)
+    return os.path.join(d, f'{name}.lock')
+  def _update_manifest(self, keys):
+    """ отметить записанные месяцы в общем манифесте папки данных """
+    with FileLock(self._lock_filename('manifest')):
+      d = { 'version': 0, 'months': {} }
+      try:
+        with open(self._manifest_filename, 'r', encoding = 'UTF8') as f:
+          d = json.load(f)
+      except (OSError, ValueError) as err:
+        if os.path.lexists(self._manifest_filename):
+          logging.warning(f'Rebuild broken manifest "{self._manifest_filename}": {err}')
+      d['version'] = d.get('version', 0) + 1
+      months = d.setdefault('months', {})
+      for year, month in keys:
+        st = os.stat(self.compute_csv_filename(year, month))
+        months[f'{year}-{month:02d}'] = { 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'version': d['version'] }
+      tmp = f'{self._manifest_filename}.{os.getpid()}.tmp'
+      with open(tmp, 'w', encoding = 'UTF8') as f:
+        json.dump(d, f, ensure_ascii = False, indent = 1, sort_keys = True)
+      os.replace(tmp, self._manifest_filename)
+    #собственная запись не требует пересканирования
+    self._manifest_stamp = _file_stamp(self._manifest_filename)
   def scan(self):
-    if self._scanned:
+    stamp = _file_stamp(self._manifest_filename)
+    if self._scanned and (stamp == self._manifest_stamp):
       return
+    if self._scanned:
+      logging.debug(f'Data directory "{self.dir}" is changed by another process, rescan')
+      self._year_matrices = {}
+    self._manifest_stamp = stamp
     reg_exp = re.compile(r'(\d{4})-(\d\d).csv')
     self._month_masks_by_year = {}
     for fn in glob.glob(os.path.join(self.dir, '[0-9][0-9][0-9][0-9]-[0-9][0-9].csv')):
@@ -66,13 +341,36 @@ class Storage:
         month = int(m.group(2))
         self._add_month(year, month)
     self._scanned = True
+  def invalidate(self):
+    """ забыть результаты сканирования и кеш, если месячные файлы изменены другим процессом """
+    self._scanned = False
+    self._year_matrices = {}
+  def data_version(self):
+    """ отпечаток общего манифеста, меняется при каждой записи в хранилище любым процессом """
+    return _file_stamp(self._manifest_filename)
+  def files_version(self) -> str:
+    """ отпечаток имен, размеров и времени изменения месячных файлов """
+    h = hashlib.sha1()
+    with os.scandir(self.dir) as it:
+      for e in sorted(it, key = lambda e: e.name):
+        if e.name.endswith('.csv'):
+          st = e.stat()
+          h.update(f'{e.name}:{st.st_size}:{st.st_mtime_ns};'.encode('UTF8'))
+    return h.hexdigest()
   def available_years(self):
     self.scan()
     a = list(self._month_masks_by_year.keys())
     a.sort()
     return a
   def _load_month_data(self, year, month):
-    csv_filename = self.compute_csv_filename(year, month)
+    return self._read_month_file(self.compute_csv_filename(year, month))
+  def _month_values(self, csv_filename):
+    """ массив строки × столбцы значений месячного файла или None """
+    d = self._read_month_file(csv_filename)
+    if d is None:
+      return None
+    return np.array([[cell_value(x) for x in row] for row in d], dtype = np.float64).reshape(len(d), self._month_columns)
+  def _read_month_file(self, csv_filename):
     a = []
     with open(csv_filename, 'r', newline='', encoding = 'UTF8') as csvfile:
       reader = csv.reader(csvfile, delimiter=' ', quotechar='"', quoting=csv.QUOTE_MINIMAL)
@@ -86,6 +384,7 @@ class Storage:
           return None
         a.append(data[1:])
     return a
+  @perf.timed('load_year_data')
   def load_year_data(self, year):
     self.scan()
     logging.debug(f'load_year_data for {year} year')
@@ -102,22 +401,123 @@ class Storage:
         for w, v in zip(a, d):
           w.extend(v)
     return (months, a)
+  def _year_matrix(self, year):
+    m = self._year_matrices.get(year)
+    if m is None:
+      months, data = self.load_year_data(year)
+      m = YearMatrix(months, data, self._month_columns)
+      self._year_matrices[year] = m
+    return m
+  def load_year_matrix(self, year) -> YearMatrix:
+    """
+    числовое представление года с разницами по месяцам, кешируется до записи в этот или предыдущий год
+    (в том числе другим процессом: scan сбрасывает кеш при изменении манифеста)
+    """
+    self.scan()
+    m = self._year_matrix(year)
+    if (year - 1) in self._month_masks_by_year:
+      m.set_previous_year(self._year_matrix(year - 1))
+    return m
+  def _read_rollups(self):
+    """ returns year -> YearRollup из файла итогов (пустой словарь, если файла нет или схема изменилась) """
+    try:
+      with open(self._rollups_filename, 'r', encoding = 'UTF8') as f:
+        d = json.load(f)
+    except (OSError, ValueError) as err:
+      if os.path.lexists(self._rollups_filename):
+        logging.warning(f'Ignore broken rollups "{self._rollups_filename}": {err}')
+      return {}
+    rows = [r[0] for r in self.schema.rows]
+    if (d.get('rows') != rows) or (d.get('columns') != self._month_columns):
+      logging.info(f'Rollups "{self._rollups_filename}" don\'t match schema "{self.schema_filename}", rebuild')
+      return {}
+    try:
+      return { int(y): YearRollup.from_json(v, len(rows), self._month_columns) for y, v in d['years'].items() }
+    except (KeyError, ValueError) as err:
+      logging.info(f'Rollups "{self._rollups_filename}" have an old format ({err}), rebuild')
+      return {}
+  def _update_rollups(self, update):
+    """ update(year -> YearRollup) изменяет итоги, которые перечитываются и сохраняются под блокировкой """
+    with FileLock(self._lock_filename('rollups')):
+      rollups = self._read_rollups()
+      update(rollups)
+      d = { 'rows': [r[0] for r in self.schema.rows], 'columns': self._month_columns,
+            'years': { str(y): r.to_json() for y, r in sorted(rollups.items()) } }
+      tmp = f'{self._rollups_filename}.{os.getpid()}.tmp'
+      with open(tmp, 'w', encoding = 'UTF8') as f:
+        json.dump(d, f, ensure_ascii = False)
+      os.replace(tmp, self._rollups_filename)
+      self._rollups = rollups
+      self._rollups_stamp = _file_stamp(self._rollups_filename)
+  def year_rollup(self, year: int, persist: bool = True) -> YearRollup:
+    """
+    итоги года без чтения месячных файлов; если итогов нет или они не соответствуют
+    набору месячных файлов (данные записаны старой версией), год пересчитывается один раз,
+    с persist=False пересчитанные итоги не сохраняются и в папку данных ничего не пишется
+    """
+    self.scan()
+    stamp = _file_stamp(self._rollups_filename)
+    if stamp != self._rollups_stamp:
+      self._rollups = self._read_rollups()
+      self._rollups_stamp = stamp
+    mask = self._month_masks_by_year.get(year, 0)
+    if mask == 0:
+      return YearRollup(len(self.schema.rows), self._month_columns)
+    r = self._rollups.get(year)
+    if (not r is None) and (r.mask == mask):
+      return r
+    logging.debug(f'Rebuild rollups of {year} year in "{self.dir}"')
+    m = self._year_matrix(year)
+    r = YearRollup(len(self.schema.rows), self._month_columns)
+    for j, month in enumerate(m.months):
+      r.add_month(month, m.values[:, j, :])
+    #поврежденные месячные файлы не попадают в итоги, но и не вызывают повторного пересчета
+    r.mask = mask
+    if not persist:
+      return r
+    def update(rollups):
+      rollups[year] = r
+    self._update_rollups(update)
+    return r
+  def rollups(self, persist: bool = True) -> dict:
+    """ year -> YearRollup для всех лет хранилища """
+    return { year: self.year_rollup(year, persist) for year in self.available_years() }
   def save_csv(self, year: int, month: int, rl: tsv.ReceiptLines) -> int:
     """
+    существующий файл месяца заменяется атомарно,
     returns combination of flags (NEW_YEAR and NEW_MONTH)
     """
+    with self.batch() as b:
+      b.add(year, month, rl)
+    return b.flags
+  @contextlib.contextmanager
+  def batch(self):
+    """
+    запись нескольких месяцев с одной синхронизацией каталога (каждый файл синхронизируется отдельно, см. _Batch):
+      with s.batch() as b:
+        b.add(year, month, rl)
+    флаги NEW_YEAR и NEW_MONTH накапливаются в b.flags, при исключении ничего не записывается,
+    квитанции сейчас сохраняются по одной (save_csv), пакет из нескольких месяцев - для импорта архивов
+    """
     self.scan()
-    #TODO: consider case when csv file is already exist
-    res = 0
-    csv_filename = self.compute_csv_filename(year, month)
-    with open(csv_filename, 'w', newline='', encoding = 'UTF8') as csvfile:
-      rl.export_csv(csvfile, self.schema)
-      res += self._add_month(year, month)
-    return res
+    b = _Batch(self)
+    try:
+      yield b
+    except BaseException:
+      b.discard()
+      raise
+    try:
+      b.commit()
+    finally:
+      b.discard()
+  def matched_rows(self, rl: tsv.ReceiptLines) -> int:
+    """ сколько строк схемы хранилища найдено в квитанции, используется для выбора хранилища """
+    return rl.matched_rows(self.schema)
 
-def load_storages(dirname: str) -> list[Storage]:
+def load_storages(dirname: str = None) -> list[Storage]:
   a = []
-  dirname = io_utils.script_dirname()
+  if dirname is None:
+    dirname = io_utils.script_dirname()
   for fn in sorted(glob.glob(io_utils.path_join(dirname, '*.json'))):
     s = Storage(fn)
     if not s.is_valid():
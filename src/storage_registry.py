@@ -0,0 +1,129 @@
+# -*- coding: UTF8 -*-
+"""
+реестр хранилищ для большого количества счетов: список хранилищ берется из легкого манифеста,
+Storage создается только при выборе и закрывается, если давно не использовался
+"""
+
+from collections import OrderedDict
+import glob
+import json
+import logging
+import os
+
+import io_utils
+import storage
+
+#имя начинается с точки, поэтому манифест не попадает в glob('*.json')
+MANIFEST_FILENAME = '.storages-manifest.json'
+
+class StorageRegistry:
+  """
+  refresh перечитывает только новые и измененные json файлы, файлы, которые не являются схемами хранилищ, пропускаются
+  >>> import tempfile
+  >>> d = tempfile.TemporaryDirectory()
+  >>> def schema(name, title, ns = None):
+  ...   fn = os.path.join(d.name, name)
+  ...   with open(fn, 'w', encoding = 'UTF8') as f:
+  ...     json.dump({ 'title': title, 'rows_schema_csv_filename': 'schema.csv' }, f)
+  ...   if not ns is None:
+  ...     os.utime(fn, ns = (ns, ns))
+  >>> schema('a.json', 'Квартира', 10**18)
+  >>> with open(os.path.join(d.name, 'other.json'), 'w') as f:
+  ...   f.write('[]')
+  2
+  >>> r = StorageRegistry(d.name)
+  >>> len(r), r.titles(), os.path.lexists(os.path.join(d.name, MANIFEST_FILENAME))
+  (1, ['Квартира'], True)
+  >>> schema('a.json', 'Дача', 2 * 10**18)
+  >>> schema('b.json', 'Гараж')
+  >>> r.refresh()
+  >>> r.titles(), r.search('дач')
+  (['Дача', 'Гараж'], [0])
+  >>> d.cleanup()
+  """
+  def __init__(self, dirname: str = None, max_open = 8):
+    if dirname is None:
+      dirname = io_utils.script_dirname()
+    self.dirname = dirname
+    self.max_open = max_open
+    self._manifest_filename = io_utils.path_join(dirname, MANIFEST_FILENAME)
+    #список словарей: filename, mtime_ns, title
+    self._entries = []
+    #filename -> Storage, в порядке последнего использования
+    self._open = OrderedDict()
+    self.refresh()
+  def _load_manifest(self):
+    if not os.path.lexists(self._manifest_filename):
+      return {}
+    try:
+      with open(self._manifest_filename, 'r', encoding = 'UTF8') as f:
+        return { e['filename']: e for e in json.load(f) }
+    except (OSError, ValueError, KeyError, TypeError) as err:
+      logging.warning(f'Ignore broken manifest "{self._manifest_filename}": {err}')
+      return {}
+  def _save_manifest(self):
+    tmp = self._manifest_filename + '.tmp'
+    try:
+      with open(tmp, 'w', encoding = 'UTF8') as f:
+        json.dump(self._entries, f, ensure_ascii = False)
+      os.replace(tmp, self._manifest_filename)
+    except OSError as err:
+      logging.warning(f'Can not write manifest "{self._manifest_filename}": {err}')
+  def refresh(self):
+    """ перечитываются только json файлы, которых нет в манифесте или которые изменились """
+    old = self._load_manifest()
+    entries = []
+    modified = False
+    for fn in sorted(glob.glob(io_utils.path_join(self.dirname, '*.json'))):
+      mtime_ns = os.stat(fn).st_mtime_ns
+      e = old.get(fn)
+      if (e is None) or (e['mtime_ns'] != mtime_ns):
+        modified = True
+        try:
+          with open(fn, 'r', encoding = 'UTF8') as f:
+            d = json.load(f)
+        except (OSError, ValueError) as err:
+          logging.warning(f'Skip invalid json file "{fn}": {err}')
+          continue
+        if (not isinstance(d, dict)) or (not 'rows_schema_csv_filename' in d):
+          logging.warning(f'Skip json file "{fn}", it is not a storage schema')
+          continue
+        e = { 'filename': fn, 'mtime_ns': mtime_ns, 'title': d.get('title', '') }
+      entries.append(e)
+    self._entries = entries
+    if modified or (len(entries) != len(old)):
+      self._save_manifest()
+    logging.debug(f'{len(entries)} storages are registered in "{self.dirname}"')
+  def __len__(self):
+    return len(self._entries)
+  def title(self, i):
+    return self._entries[i]['title']
+  def titles(self):
+    return [e['title'] for e in self._entries]
+  def search(self, text):
+    """ номера хранилищ, в названии (или имени файла) которых встречается text без учета регистра """
+    t = text.casefold()
+    return [i for i, e in enumerate(self._entries)
+            if (t in e['title'].casefold()) or (t in os.path.basename(e['filename']).casefold())]
+  def open(self, i) -> storage.Storage:
+    """ returns хранилище (создается при первом обращении) или None, если схема неправильная """
+    fn = self._entries[i]['filename']
+    s = self._open.get(fn)
+    if not s is None:
+      self._open.move_to_end(fn)
+      return s
+    s = storage.Storage(fn)
+    if not s.is_valid():
+      logging.warning(f'Skip invalid json file "{fn}"')
+      return None
+    self._open[fn] = s
+    while len(self._open) > self.max_open:
+      old_fn, _ = self._open.popitem(last = False)
+      logging.debug(f'Close idle storage "{old_fn}"')
+    return s
+  def open_storages(self):
+    return list(self._open.values())
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod(verbose=True)
@@ -2,10 +2,12 @@
 """
 разбор файлов в формате tsv, полученных от утилиты pdftotext, согласно заданной схемы
 """
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import csv
 import json
 import logging
+import os
 import re
 from typing import Optional, Union
 from datetime import datetime
@@ -13,6 +15,9 @@ from datetime import datetime
 #import schema
 import pandas as pd
 
+import log
+import schema_cache
+
 #https://ru.stackoverflow.com/questions/810304/Как-вывести-названия-месяцев-без-склонения-в-calendar
 _RU_MONTHS = ['Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь', 'Июль', 'Август', 'Сентябрь', 'Октябрь', 'Ноябрь', 'Декабрь']
 
@@ -28,13 +33,6 @@ class Row:
   def __str__(self):
     return str(vars(self))
 
-def _lines_text(line):
-  return ' '.join(map(lambda x: x.text, line))
-def _lines_debug(line):
-  return ' '.join(map(str, line))
-def _lines_with_attr(line, attr):
-  return ' '.join(map(lambda x: f'{x.text}({getattr(x, attr)})', line))
-
 class NumberRecognizer:
   def __init__(self):
     self.re_number = re.compile(r'-?\d{1,10}((\.|,)\d{0,6})?')
@@ -69,126 +67,121 @@ class NumberRecognizer:
 def contains_digits(s):
   return any(map(lambda x: x.isdigit(), s))
 
-class _Line:
-  """depricated"""
-  def _add_number(self, s):
-    self.numbers.append(s.replace('.', ','))
-  def __init__(self, rows, nr, parse_date):
-    #state: 0 (читаем название), 1 (читаем числа)
-    state = 0
-    names = []
-    self.numbers = []
-    rows.sort(key = lambda x: float(x.left))
-    for row in rows:
-      s = row.text
-      if state == 0:
-        if contains_digits(s):
-          state = 1
-          if nr.is_number(s):
-            self._add_number(s)
-        else: names.append(s)
-      else:
-        if nr.is_number(s):
-          self._add_number(s)
-    self.name = ' '.join(names)
-    if parse_date:
-      self.date = None
-      for i in range(1, len(rows)):
-        year = rows[i].text
-        if nr.is_year(year):
-          month = nr.get_month_number(rows[i-1].text)
-          if not month is None:
-            self.date = (int(year), month)
-            break
-  def _startswith(self, s):
-    return self.name.startswith(s)
-  def matched(self, s):
-    """ ' / ' в названии строчки s используется как один из вариантов (содержание газонов или уборка снега) """
-    return any(map(self._startswith, s.split(' / ')))
-  def extract(self, columns):
-    max_idx = max(columns)
-    if max_idx >= len(self.numbers):
-      logging.debug(f'Can not extract {columns} from {self.numbers} for {self.name}.')
-      return None
-    a = []
-    for idx in columns:
-      a.append('' if idx < 0 else self.numbers[idx])
-    return a
+#линия квитанции после разбора: страница, позиция top, название, числа, их исходная запись
+#(с запятой, так она сохраняется в месячные файлы), позиции left чисел,
+#найденная в линии дата и охватывающий прямоугольник (left, top, right, bottom)
+_ParsedLine = namedtuple('_ParsedLine', ['page', 'top', 'name', 'numbers', 'texts', 'lefts', 'date', 'bbox'])
+
+def _line_bbox(data):
+  left = min(map(lambda x: float(x.left), data))
+  top = min(map(lambda x: float(x.top), data))
+  right = max(map(lambda x: float(x.left) + float(x.width), data))
+  bottom = max(map(lambda x: float(x.top) + float(x.height), data))
+  return (left, top, right, bottom)
 
-class _ReceiptLines:
+def _parse_line(data, nr):
+  """ returns (name, numbers, texts, lefts, date) """
+  state = 0
+  #state: 0 (читаем название), 1 (читаем числа)
+  #числа или float, либо cтрока '-' означающая отсутствие данных
+  names = []
+  data.sort(key = lambda x: float(x.left))
+  numbers = []
+  texts = []
+  lefts = []
+  for row in data:
+    s = row.text
+    if state == 0:
+      if (s == '-') or contains_digits(s):
+        state = 1
+        x = nr.parse_number(s)
+        if not x is None:
+          numbers.append(x)
+          texts.append(s.replace('.', ','))
+          lefts.append(float(row.left))
+      else: names.append(s)
+    else:
+      x = nr.parse_number(s)
+      if not x is None:
+        numbers.append(x)
+        texts.append(s.replace('.', ','))
+        lefts.append(float(row.left))
+  date = None
+  for i in range(1, len(data)):
+    year = data[i].text
+    if nr.is_year(year):
+      month = nr.get_month_number(data[i-1].text)
+      if not month is None:
+        date = (int(year), month)
+        break
+  return (' '.join(names), numbers, texts, lefts, date)
+
+def _line_extract(line, columns):
+  max_idx = max(columns)
+  if max_idx >= len(line.numbers):
+    logging.debug(f'Can not extract {columns} from {line.numbers} for {line.name}.')
+    return None
+  return ['' if idx < 0 else line.texts[idx] for idx in columns]
+
+class ReceiptLines:
   def __init__(self):
     self.nr = NumberRecognizer()
     self.first_date = None
+    #линия, в которой найдена дата квитанции
+    self.date_line = None
     self._lines = []
-  def add_line(self, data):
-    state = 0
-    #state: 0 (читаем название), 1 (читаем числа)
-    #числа или float, либо cтрока '-' означающая отсутствие данных
-    names = []
-    data.sort(key = lambda x: float(x.left))
-    numbers = []
-    nr = self.nr
-    for row in data:
-      s = row.text
-      if state == 0:
-        if (s == '-') or contains_digits(s):
-          state = 1
-          x = nr.parse_number(s)
-          if not x is None:
-            numbers.append(x)
-        else: names.append(s)
-      else:
-        x = nr.parse_number(s)
-        if not x is None:
-          numbers.append(x)
-    name = ' '.join(names)
-    if self.first_date is None:
-      self.date = None
-      for i in range(1, len(data)):
-        year = data[i].text
-        if nr.is_year(year):
-          month = nr.get_month_number(data[i-1].text)
-          if not month is None:
-            self.first_date = (int(year), month)
-            break
-    if len(name) > 0:
-      self._lines.append((name, numbers))
+  def add_parsed_line(self, line):
+    if (self.first_date is None) and (not line.date is None):
+      self.first_date = line.date
+      self.date_line = line
+    if len(line.name) > 0:
+      self._lines.append(line)
   def first_strdate(self):
     d = self.first_date
     if d is None:
       return 'unknown'
     return f'{d[0]}-{d[1]:02d}'
-  def get_numbers(self, name, columns):
+  def numbers_by_row(self, extraction_schema):
+    """
+    числа для каждой строки схемы (или None), линии сопоставляются со строками
+    по скомпилированному словарю начал названий, а не перебором всех пар
+    """
+    c = extraction_schema.compiled
+    by_row = defaultdict(list)
     for l in self._lines:
-      if not l.matched(name):
-        continue
-      r = l.extract(columns)
-      if not r is None:
-        return r
-    return None
-  '''
-  def _export_row(self, writer, name, columns):
-    n = self.get_numbers(name, columns)
+      for i in c.prefix_rows(l.name):
+        by_row[i].append(l)
+    a = []
+    for i, (_name, _units, columns) in enumerate(c.rows):
+      r = None
+      for l in by_row.get(i, []):
+        r = _line_extract(l, columns)
+        if not r is None:
+          break
+      a.append(r)
+    return a
+  def _export_row(self, writer, name, columns, n):
     if n is None:
       logging.warning(f'row "{name}" is broken in {self.first_strdate()}')
       n = ['?' for _ in columns]
     n.insert(0, name)
     writer.writerow(n)
-  def export_csv(self, csvfile, extraction_schema: schema.ExtractionSchema):
+  def export_csv(self, csvfile, extraction_schema):
     writer = csv.writer(csvfile, delimiter=' ', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-    for (name, _units, columns) in extraction_schema.rows:
-      self._export_row(writer, name, columns)
-  '''
+    for (name, _units, columns), n in zip(extraction_schema.rows, self.numbers_by_row(extraction_schema)):
+      self._export_row(writer, name, columns, n)
+  def matched_rows(self, extraction_schema):
+    """ количество строк схемы, найденных в квитанции """
+    return sum(map(lambda n: not n is None, self.numbers_by_row(extraction_schema)))
+
+def _line_key(row):
+  return (int(row.page_num), float(row.top))
 
-def _group_by(rows, attr):
+def _group_by_line(rows):
+  """ группировка по странице и позиции top (в разных страницах могут быть одинаковые top) """
   d = defaultdict(list)
   for row in rows:
-    d[getattr(row, attr)].append(row)
-  for i, a in d.items():
-    logging.debug(f'{attr} #{i}: {_lines_text(a)}')
-    logging.debug(f'{attr} #{i}: {_lines_with_attr(a, "line_num")}')
-    logging.debug(f'{attr} #{i}: {_lines_with_attr(a, "left")}')
-    #logging.debug('{} #{}: {}'.format(attr, i, lines_debug(a)))
+    d[_line_key(row)].append(row)
   return d
 
 def _csv_readall(reader):
@@ -207,47 +200,343 @@ def _read(input_filename):
     return _csv_readall(reader)
 
 def load_json_configuration(json_configuration_filename):
-  with open(json_configuration_filename) as f:
+  """ скомпилированная (и закешированная на диске) конфигурация, доступна как исходный словарь """
+  c = schema_cache.load_configuration(json_configuration_filename)
+  if c is None:
+    log.raise_value_error(f'Invalid json configuration "{json_configuration_filename}"')
+  return c
+
+def _parse_tsv_lines(input_filename):
+  """ разбор одного tsv файла в список линий, упорядоченный по странице и top """
+  rows = _read(input_filename)
+  nr = NumberRecognizer()
+  a = []
+  for (page, top), group in _group_by_line(rows).items():
+    name, numbers, texts, lefts, date = _parse_line(group, nr)
+    a.append(_ParsedLine(page, top, name, numbers, texts, lefts, date, _line_bbox(group)))
+  a.sort(key = lambda l: (l.page, l.top))
+  return a
+
+def _receipt_lines(input_filenames, jobs = None):
+  """
+  разбирает tsv файлы (например отдельные диапазоны страниц) параллельно в разных процессах
+  и объединяет линии с учетом порядка страниц и позиций top
+  """
+  if len(input_filenames) == 1:
+    parsed = [_parse_tsv_lines(input_filenames[0])]
+  else:
+    with ProcessPoolExecutor(max_workers = jobs) as executor:
+      parsed = list(executor.map(_parse_tsv_lines, input_filenames))
+  lines = [l for a in parsed for l in a]
+  lines.sort(key = lambda l: (l.page, l.top))
+  rl = ReceiptLines()
+  for l in lines:
+    rl.add_parsed_line(l)
+  return rl
+
+def read_receipt_lines(input_filenames, jobs = None):
+  """ линии квитанции без сопоставления со схемой (для экспорта в месячные csv файлы storage) """
+  return _receipt_lines(input_filenames, jobs)
+
+def parse_receipt_lines(rl, configuration_from_json, input_filename = '', region = None, template = None):
+  """
+  разбор уже прочитанных линий квитанции по json конфигурации (без повторного чтения tsv файлов),
+  если передан словарь region, то в него записывается область страницы (page, x, y, W, H),
+  охватывающая дату и все найденные строки схемы,
+  если передан LayoutTemplate, то строки вначале ищутся по шаблону, а шаблон обновляется
+  """
+  if len(rl._lines) == 0:
+    return []
+  return _parse_configuration(rl, configuration_from_json, input_filename, region, template)
+
+def crop_complete(rl, series, configuration_from_json, region):
+  """
+  достаточно ли линий из области страницы: найдены все строки схемы, которые нашлись при полном разборе,
+  по которому выучена область (сезонные строки есть не в каждой квитанции, для заданной в схеме области - все строки),
+  и видна линия, которая тогда шла сразу после таблицы, - иначе нижний край области мог отрезать новые строки
+  >>> c = { 'rows': [{ 'name': 'a' }, { 'name': 'b' }, { 'name': 'c' }] }
+  >>> L = lambda name: _ParsedLine(1, 0.0, name, [], [], [], None, (0, 0, 1, 1))
+  >>> rl = ReceiptLines()
+  >>> for name in ['a', 'b', 'Итого']: rl.add_parsed_line(L(name))
+  >>> s = [{ 'row': 'a' }, { 'row': 'b' }]
+  >>> crop_complete(rl, s, c, { 'page': 1 }), crop_complete(rl, s, c, { 'rows': ['a', 'b'], 'end': 'Итого' })
+  (False, True)
+  >>> crop_complete(rl, s, c, { 'rows': ['a', 'b'], 'end': 'Всего' })
+  False
+  """
+  found = set(map(lambda x: x['row'], series))
+  required = region.get('rows', [r['name'] for r in configuration_from_json['rows']])
+  if not all(map(lambda name: name in found, required)):
+    return False
+  end = region.get('end')
+  return (end is None) or any(map(lambda l: l.name == end, rl._lines))
+
+def _line_after(rl, lines):
+  """ первая линия страницы ниже всех линий lines или None """
+  page = lines[0].page
+  bottom = max(map(lambda l: l.bbox[3], lines))
+  a = [l for l in rl._lines if (l.page == page) and (l.bbox[1] >= bottom) and not l in lines]
+  return min(a, key = lambda l: l.top, default = None)
+
+_REGION_MARGIN = 8.0
+
+def _lines_region(lines):
+  """
+  >>> L = lambda page, bbox: _ParsedLine(page, bbox[1], '', [], [], [], None, bbox)
+  >>> _lines_region([L(1, (30, 40, 200, 50)), L(1, (20, 100, 500, 112))])
+  {'page': 1, 'x': 12, 'y': 32, 'W': 497, 'H': 89}
+  >>> _lines_region([L(1, (30, 40, 200, 50)), L(2, (20, 100, 500, 112))]) is None
+  True
+  """
+  pages = set(map(lambda l: l.page, lines))
+  if len(pages) != 1:
+    return None
+  m = _REGION_MARGIN
+  left = max(0.0, min(map(lambda l: l.bbox[0], lines)) - m)
+  top = max(0.0, min(map(lambda l: l.bbox[1], lines)) - m)
+  right = max(map(lambda l: l.bbox[2], lines)) + m
+  bottom = max(map(lambda l: l.bbox[3], lines)) + m
+  return { 'page': pages.pop(), 'x': int(left), 'y': int(top), 'W': int(right - left + 1), 'H': int(bottom - top + 1) }
+
+def region_filename(json_configuration_filename):
+  """
+  >>> region_filename('conf/schema-receipt.json')
+  'conf/schema-receipt.region.json'
+  """
+  return os.path.splitext(json_configuration_filename)[0] + '.region.json'
+
+def configuration_region(configuration_from_json, json_configuration_filename):
+  """
+  область страницы с таблицей: либо задана в схеме ключом "region",
+  либо выучена по предыдущим квитанциям, иначе None
+  """
+  region = configuration_from_json.get('region')
+  if not region is None:
+    return region
+  fn = region_filename(json_configuration_filename)
+  if not os.path.lexists(fn):
+    return None
+  with open(fn, 'r', encoding = 'UTF8') as f:
     return json.load(f)
 
-def read_and_parse(input_filename, configuration_from_json):
+def save_learned_region(json_configuration_filename, region):
+  fn = region_filename(json_configuration_filename)
+  logging.debug(f'Saving learned region {region} to "{fn}"')
+  with open(fn, 'w', encoding = 'UTF8') as f:
+    json.dump(region, f)
+
+def _normalize_name(s):
+  """
+  >>> _normalize_name('Уборка  МОП')
+  'уборкамоп'
+  """
+  return ''.join(s.lower().split())
+
+def _ngrams(s, n):
+  """ n-граммы строки с позицией первого вхождения
+  >>> _ngrams('abcab', 3)
+  {'abc': 0, 'bca': 1, 'cab': 2}
+  """
+  d = {}
+  for i in range(max(1, len(s) - n + 1)):
+    d.setdefault(s[i:i+n], i)
+  return d
+
+#допустимое смещение n-граммы в линии относительно конца названия строки схемы
+_NGRAM_SLACK = 3
+
+class RowNameIndex:
+  """
+  инвертированный индекс n-грамм названий строк схемы для сопоставления с линиями квитанции,
+  устойчивого к изменению сокращений, регистра и лишним пробелам;
+  оценка строки - доля её n-грамм, встреченных в начале линии
+  >>> index = RowNameIndex(['Уборка МОП', 'Орг-я раб. Аварийно-Диспет. службы'])
+  >>> index.candidates('Уборка  МОП')
+  [(1.0, 0)]
+  >>> index.candidates('Орг-я раб. аварийно-диспетч. службы')
+  [(0.9310344827586207, 1)]
+  >>> index.candidates('Управление МКД')
+  []
+  """
+  def __init__(self, names, n = 3, threshold = 0.85):
+    self.n = n
+    self.threshold = threshold
+    self._lengths = []
+    self._sizes = []
+    self._index = defaultdict(list)
+    for i, name in enumerate(names):
+      s = _normalize_name(name)
+      grams = _ngrams(s, n)
+      self._lengths.append(len(s))
+      self._sizes.append(len(grams))
+      for g in grams:
+        self._index[g].append(i)
+  def candidates(self, line_name):
+    """ returns список (оценка, номер строки) с оценкой не ниже порога, по убыванию оценки """
+    hits = defaultdict(int)
+    for g, pos in _ngrams(_normalize_name(line_name), self.n).items():
+      for i in self._index.get(g, []):
+        if pos + self.n <= self._lengths[i] + _NGRAM_SLACK:
+          hits[i] += 1
+    a = [(h / self._sizes[i], i) for i, h in hits.items() if h >= self.threshold * self._sizes[i]]
+    a.sort(key = lambda t: (-t[0], t[1]))
+    return a
+
+def _match_lines_by_index(rl, compiled, threshold):
+  """
+  для каждой строки схемы лучшая линия квитанции: точное совпадение начала названия,
+  иначе линия с наибольшей оценкой по n-граммам (первая по порядку при равных оценках),
+  линии, в которых чисел меньше, чем столбцов строки, не рассматриваются,
+  returns словарь номер строки -> (оценка, линия)
+  >>> c = schema_cache.compile_configuration({ 'rows': [{ 'name': 'Управление МКД', 'columns_ids': [0, 2] }],
+  ...                                          'columns': ['тариф', 'объем', 'начислено'] })
+  >>> L = lambda name, numbers: _ParsedLine(1, 0.0, name, numbers, [], [], None, (0, 0, 1, 1))
+  >>> rl = ReceiptLines()
+  >>> rl.add_parsed_line(L('управление мкд', [5.0]))
+  >>> _match_lines_by_index(rl, c, 0.85)
+  {}
+  >>> rl.add_parsed_line(L('Управление  МКД', [5.0, 7.0]))
+  >>> _match_lines_by_index(rl, c, 0.85)[0][1].numbers
+  [5.0, 7.0]
+  """
+  row_names = compiled.row_names
+  index = compiled.memo(('row_name_index', threshold), lambda: RowNameIndex(row_names, threshold = threshold))
+  best = {}
+  for l in rl._lines:
+    for score, i in index.candidates(l.name):
+      if len(l.numbers) < len(compiled.column_map[i]):
+        continue
+      key = (l.name.startswith(row_names[i]), score)
+      old = best.get(i)
+      if (old is None) or (key > old[0]):
+        best[i] = (key, l)
+  return { i: (key[1], l) for i, (key, l) in best.items() }
+
+_TEMPLATE_TOP_TOLERANCE = 2.0
+_TEMPLATE_LEFT_TOLERANCE = 6.0
+
+def layout_template_filename(json_configuration_filename):
+  """
+  >>> layout_template_filename('conf/schema-receipt.json')
+  'conf/schema-receipt.layout.json'
+  """
+  return os.path.splitext(json_configuration_filename)[0] + '.layout.json'
+
+class LayoutTemplate:
+  """
+  шаблон расположения строк схемы по последней успешно разобранной квитанции:
+  для каждой строки страница, позиция top и позиции left чисел,
+  строки новой квитанции вначале ищутся по шаблону и только несовпавшие полным перебором
+  """
+  def __init__(self, rows = None):
+    self.rows = {} if rows is None else rows
+    #метрики смещения разметки последнего разбора
+    self.drift = {}
+    self._index = None
+    self._learned = None
+  @classmethod
+  def load(cls, filename):
+    if not os.path.lexists(filename):
+      return cls()
+    with open(filename, 'r', encoding = 'UTF8') as f:
+      return cls(json.load(f))
+  def save(self, filename):
+    with open(filename, 'w', encoding = 'UTF8') as f:
+      json.dump(self.rows, f, ensure_ascii = False)
+  def begin(self, rl):
+    self._index = defaultdict(list)
+    for l in rl._lines:
+      self._index[(l.page, round(l.top))].append(l)
+    self._learned = {}
+    self.drift = { 'rows': 0, 'template_hits': 0, 'fallbacks': 0, 'max_top_shift': 0.0, 'max_left_shift': 0.0 }
+  def match(self, row_name):
+    """ линия по шаблону или None """
+    self.drift['rows'] += 1
+    t = self.rows.get(row_name)
+    if not t is None:
+      top = round(t['top'])
+      for dt in (0, -1, 1, -2, 2):
+        for l in self._index.get((t['page'], top + dt), []):
+          top_shift = abs(l.top - t['top'])
+          if (top_shift > _TEMPLATE_TOP_TOLERANCE) or (len(l.lefts) != len(t['lefts'])) or (not l.name.startswith(row_name)):
+            continue
+          left_shift = max(map(lambda x: abs(x[0] - x[1]), zip(l.lefts, t['lefts'])), default = 0.0)
+          if left_shift > _TEMPLATE_LEFT_TOLERANCE:
+            continue
+          d = self.drift
+          d['template_hits'] += 1
+          d['max_top_shift'] = max(d['max_top_shift'], top_shift)
+          d['max_left_shift'] = max(d['max_left_shift'], left_shift)
+          return l
+    self.drift['fallbacks'] += 1
+    return None
+  def learn(self, row_name, line):
+    self._learned[row_name] = { 'page': line.page, 'top': line.top, 'lefts': line.lefts }
+  def end(self, input_filename):
+    self.rows.update(self._learned)
+    self._index = None
+    self._learned = None
+    logging.info("Layout drift in '%s': %s", input_filename, self.drift)
+
+def _parse_configuration(rl, configuration_from_json, input_filename, region = None, template = None):
   d = configuration_from_json
-  rows = _read(input_filename)
-  rl = _ReceiptLines()
-  for group in _group_by(rows, 'top').values():
-    rl.add_line(group)
+  c = schema_cache.compile_configuration(d)
   series = []
   assert(len(rl._lines) > 0)
+  if rl.first_date is None:
+    logging.error(f"Date is not found in '{input_filename}'")
+    return series
+  matched_lines = [rl.date_line]
+  if not template is None:
+    template.begin(rl)
   logging.debug("Found %d interesting lines in file '%s'.", len(rl._lines), input_filename)
   #print(d['rows'])
   logging.debug("Found %d rows in json configuration.", len(d['rows']))
-  #самая тупая реализация за квадрат
-  for r in d['rows']:
+  #строки схемы, не найденные по шаблону, ищутся по индексу n-грамм (строится только при необходимости)
+  by_index = None
+  for row_id, r in enumerate(d['rows']):
     row_name = r['name']
-    f = None
-    for l in rl._lines:
-      logging.debug('Processing line %s', str(l))
-      if l[0].startswith(row_name):
-        f = l
-        break
+    f = None if template is None else template.match(row_name)
+    if f is None:
+      if by_index is None:
+        by_index = _match_lines_by_index(rl, c, d.get('match_threshold', 0.85))
+      t = by_index.get(row_id)
+      if not t is None:
+        f = t[1]
+        if not f.name.startswith(row_name):
+          logging.info(f'row "{row_name}" is matched to line "{f.name}" with score {t[0]:.2f} in {rl.first_strdate()}')
     if f is None:
       logging.warning(f'row "{row_name}" is missed in {rl.first_strdate()}')
       continue
+    if len(f.numbers) < len(c.column_map[row_id]):
+      logging.error(f"{len(c.column_map[row_id])} numbers are expected in {f}, row_name = '{row_name}'")
+      continue
+    matched_lines.append(f)
+    if not template is None:
+      template.learn(row_name, f)
     k = 0
-    for i in r['columns_ids']:
-      if k >= len(f[1]):
-        logging.error(f"index({k}) out of range in {f}, row_name = '{row_name}'")
-      value = f[1][k]
+    for col in c.column_map[row_id]:
+      value = f.numbers[k]
       k += 1
       if value == '-':
-        logging.warning("Row '%s', column '%s' value(%s) is not a float number, use 0.0 as it value.", row_name, d['columns'][i], value)
+        logging.warning("Row '%s', column '%s' value(%s) is not a float number, use 0.0 as it value.", row_name, col, value)
         value = 0.0
       assert isinstance(value, float)
       recept_date = datetime(rl.first_date[0], rl.first_date[1], 1)
-      data = { 'date': recept_date, 'row': row_name, 'col': d['columns'][i], 'value': value }
+      data = { 'date': recept_date, 'id': d.get('id', ''), 'row': row_name, 'col': col, 'value': value }
       logging.debug('Add data: %s', data)
       series.append(pd.Series(data))
   logging.info("File '%s' contains %d records.", input_filename, len(series))
+  if not template is None:
+    template.end(input_filename)
+  if not region is None:
+    end = _line_after(rl, matched_lines)
+    r = _lines_region(matched_lines + ([] if end is None else [end]))
+    if not r is None:
+      region.update(r)
+      found = set(map(lambda x: x['row'], series))
+      region['rows'] = [row['name'] for row in d['rows'] if row['name'] in found]
+      region['end'] = None if end is None else end.name
   return series
 
   '''